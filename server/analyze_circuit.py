@@ -7,7 +7,15 @@ if __name__ == '__main__':
   parser.add_argument("--circuit_directory", metavar='DIRECTORY', type=str, required=False, help="The directory where the circuit files are located.")
   parser.add_argument("--circuit_name", metavar='NAME', type=str, required=True, help="The name of the circuit to analyze.")
   parser.add_argument("--plot", type=bool, default=True, help="Whether to plot the analysis.")
+  parser.add_argument("--compiled_circuit_directory", metavar='DIRECTORY', type=str, required=False, help="The directory where analyzed circuits are stored.")
+  parser.add_argument("--processes", metavar='N', type=int, default=1, help="The number of processes computing the distance map (0 for one per CPU).")
+  parser.add_argument("--transition_graph", action='store_true', help="Whether to compile the transition graph (requires --compiled_circuit_directory).")
   args = parser.parse_args()
   if args.circuit_directory:
     engine.Circuit.SetPath(args.circuit_directory)
-  engine.GetAnalyzer(args.circuit_name, plot=args.plot)
+  if args.compiled_circuit_directory:
+    engine.SetCompiledCircuitPath(args.compiled_circuit_directory)
+  engine.GetAnalyzer(args.circuit_name, plot=args.plot, processes=args.processes or None)
+  if args.transition_graph:
+    graph = engine.CompileTransitionGraph(args.circuit_name)
+    print 'Transition graph: %d states, %d transitions.' % (graph.NumNodes(), graph.NumEdges())
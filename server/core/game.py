@@ -36,7 +36,9 @@ class Game(object):
     self.max_players = max_players
     self.players = []
     self.creator = creator
-    self.race = engine.Race(circuit_name)
+    # Do not hold the request thread while circuits are warming up (only ready circuits are
+    # listed then). Otherwise, circuits are built on demand and the first game has to wait.
+    self.race = engine.Race(circuit_name, block=not engine.CircuitWarmupStarted())
     self.user_dict = None
     self.race_started = False
     self.race_lock = util.RWLock()
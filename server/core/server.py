@@ -18,6 +18,8 @@ _ERROR_NOT_OWNER = 4
 _ERROR_NOT_PLAYING = 5
 _ERROR_NOT_STARTED = 6
 _ERROR_WRONG_PARAMETERS = 7
+_ERROR_CIRCUIT_BUILDING = 8
+_ERROR_CIRCUIT_FAILED = 9
 
 
 class RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
@@ -63,7 +65,7 @@ class RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         self.AnswerJSON(200, self.server_handle.GetGameListing().JSONData())
 
       elif path == '/list_circuits':
-        self.AnswerJSON(200, engine.Circuit.CircuitNames())
+        self.AnswerJSON(200, engine.ReadyCircuitNames())
 
       elif path == '/create_game':
         # TODO: fix bug when unknown user creates a game (server freezes - likely deadlock).
@@ -95,6 +97,9 @@ class RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         game_instance.FillWithComputerPlayers(authentication_id=params['user'][0], computer_ai=params['computer'][0])
         self.AnswerJSON(200, None)
 
+      elif path == '/cache_stats':
+        self.AnswerJSON(200, engine.GetCacheStats())
+
       elif path == '/list_ai':
         self.AnswerJSON(200, engine.ListComputerPlayers())
 
@@ -137,6 +142,10 @@ class RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
       self.AnswerJSON(400, _ERROR_NOT_STARTED)
     except engine.HumanNotPlayingError:
       self.AnswerJSON(400, _ERROR_NOT_PLAYING)
+    except engine.AnalyzerBuildingError:
+      self.AnswerJSON(400, _ERROR_CIRCUIT_BUILDING)
+    except engine.AnalyzerBuildFailedError:
+      self.AnswerJSON(500, _ERROR_CIRCUIT_FAILED)
     finally:
       # End close.
       self.wfile.close()
@@ -2,12 +2,22 @@
 from circuit import STATUS_RUNNING
 from circuit import STATUS_DISCONNECTED
 from circuit import Circuit
+from circuit_analyzer import AnalyzerBuildingError
+from circuit_analyzer import AnalyzerBuildFailedError
 from circuit_analyzer import GetAnalyzer
+from circuit_analyzer import GetCacheStats
+from circuit_analyzer import GetTransitionGraph
+from circuit_analyzer import CompileTransitionGraph
+from circuit_analyzer import ReadyCircuitNames
+from circuit_analyzer import Warmup as WarmupCircuits
+from circuit_analyzer import WarmupStarted as CircuitWarmupStarted
+from compiled_circuit import SetPath as SetCompiledCircuitPath
 from player import HumanPlayer
 from player import CreatePlayer
 from player import ListComputerPlayers
 from player import HumanNotPlayingError
 from race import Race
+from rollout_pool import Start as StartRolloutPool
 
 ############################################
 # Add any computer player after this line. #
@@ -15,4 +25,5 @@ from race import Race
 
 import astar_player
 import fixed_depth_player
+import mcts_player
 import montecarlo_player
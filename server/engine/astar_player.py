@@ -3,7 +3,6 @@ from __future__ import print_function
 import collections
 import heapq
 import math
-import random
 import sys
 import time
 
@@ -17,6 +16,7 @@ if __name__ == '__main__':
   import circuit_analyzer
   from circuit import Circuit
 
+from circuit import DOOMED_REMOVE
 from circuit import STATUS_CRASHED
 from circuit import STATUS_FINISHED
 from circuit import State
@@ -26,9 +26,7 @@ from player import ComputerPlayer
 _YAW_RESOLUTION = 12. / math.pi  # 15 degrees.
 _SPEED_RESOLUTION = 1. / 0.5
 _INFINITY = float(sys.maxint) / 4.
-_ASTAR_FACTOR = 1.5  # Try to explore less states (the larger the faster but worse solution).
-_LENGTH_TO_LAP_FACTOR = 1. / 4. * _ASTAR_FACTOR  # 1/5 is the average number of turns for a given length.
-_MAX_DEPTH = 8
+_TIME_BUDGET = 1.  # Seconds spent per move.
 _EPSILON = 1e-3
 
 
@@ -50,61 +48,102 @@ class ApproximateState(State):
 _REMOVED = ApproximateState((0, 0), 0, 0, 0, -1000, 0, 0)  # -1000 laps.
 
 
-class AStarPlayer(ComputerPlayer):
+class _Search(object):
+  """Search state kept between turns. Expanded states are closed and the others are open."""
 
   def __init__(self):
+    self.closed_set = set()
+    self.open_set = set()
+    self.g_score = {}  # Cost of going from start to state.
+    self.h_score = {}
+    self.depths = {}
+    self.came_from = {}  # To reconstruct the path.
+    self.children = {}  # Successors of closed states.
+    self.entry_finder = {}
+    self.queue = []  # Triplet of <f_score, -depth, state>.
+    self.played = None  # Key and round of the chosen move (see CompactState).
+    self.played_state = None
+
+  def Push(self, state, g, depth):
+    self.g_score[state] = g
+    self.depths[state] = depth
+    entry = [g + self.h_score[state], -depth, state]
+    self.open_set.add(state)
+    self.entry_finder[state] = entry
+    heapq.heappush(self.queue, entry)
+
+
+class AStarPlayer(ComputerPlayer):
+
+  def __init__(self, time_budget=_TIME_BUDGET, max_depth=None):
+    # The search deepens until it reaches a finished state, max_depth (if any) or the time budget
+    # (if any).
     ComputerPlayer.__init__(self)
+    self.time_budget = time_budget
+    self.max_depth = max_depth
+    self.search = None  # Search of the previous turn.
 
   def Play(self, circuit, players, plot=False):
-    def heuristic(state):
-      if state.status == STATUS_FINISHED:
-        delta = float(state.round) - float(int(state.round))
-        return (delta - 1.) if delta > _EPSILON else 0.
-      if state.status == STATUS_CRASHED:
-        return _INFINITY
-      return (float(circuit.Laps() - state.lap - 1) * circuit.LapLength() + state.distance_left) * _LENGTH_TO_LAP_FACTOR
+    def heuristics(states):
+      # Lower bounds on the number of rounds left (see Circuit.RoundsToGo()).
+      rounds = circuit.RoundsToGoBatch(circuit.ToBatch(states)).tolist()
+      for i, state in enumerate(states):
+        if state.status == STATUS_FINISHED:
+          delta = float(state.round) - float(int(state.round))
+          rounds[i] = (delta - 1.) if delta > _EPSILON else 0.
+        elif state.status == STATUS_CRASHED or rounds[i] > _INFINITY:
+          rounds[i] = _INFINITY
+      return rounds
 
-    start_time = time.clock()
+    start_time = time.time()
+    deadline = None if self.time_budget is None else start_time + self.time_budget
 
-    # Slightly modified A* that expands only up to a given depth.
+    # Slightly modified A* that expands only up to a given depth. The depth is increased as soon
+    # as the search at the current depth is complete (i.e., when a state at that depth has the
+    # lowest f_score), which yields the same result as restarting with the deeper limit.
     # Note that we also combine with Hybrid-A* to avoid exploring too many continuous states.
     explored_states = 0
-    best_state = None  # Remember best seen state (lowest f_score at max depth).
+    depth_limit = 0
+    best_state = None  # Remember best state of the deepest complete search (lowest f_score at max depth).
     best_score = None
-    closed_set = set()
-    open_set = [ApproximateState(*s) for s in self.allowed_moves]  # Keep order.
-    g_score = collections.defaultdict(lambda: _INFINITY)  # Cost of going from start to state.
-    came_from = {}  # To reconstruct the path.
-    start_indices = {}  # To grab the best index.
-    entry_finder = {}
-    for i, s in enumerate(open_set):
-      start_indices[s] = i
-      entry_finder[s] = [1. + heuristic(s), 0, s]
-      g_score[s] = 1.
-    open_set = set(open_set)
-    queue = [entry_finder[s] for s in open_set]  # Triplet of <f_score, depth, state>.
-    heapq.heapify(queue)  # Keep the lowest f_score at easy reach.
+    best_depth = None
+    search = self._Reroot(circuit, heuristics)
+    self.search = search
+    closed_set = search.closed_set
+    open_set = search.open_set
+    g_score = search.g_score
+    came_from = search.came_from
+    entry_finder = search.entry_finder
+    queue = search.queue
+    start_indices = dict((ApproximateState(*s), i) for i, s in enumerate(self.allowed_moves))  # To grab the best index.
 
     while open_set:
-      f_score, depth, current = heapq.heappop(queue)  # Grab state with lowest f_score.
+      if deadline is not None and best_state is not None and time.time() > deadline:
+        break
+      # Grab state with lowest f_score. Ties are frequent with integer rounds and go to the deepest state.
+      f_score, depth, current = heapq.heappop(queue)
+      depth = -depth
       if current == _REMOVED:  # Ignore updated.
         continue
+      if current.status == STATUS_FINISHED or depth >= depth_limit:
+        best_state = current
+        best_score = f_score
+        best_depth = depth
+        if current.status == STATUS_FINISHED or (self.max_depth is not None and depth >= self.max_depth):
+          break  # It stays open for the next turn.
+        depth_limit = depth + 1
       entry_finder.pop(current)
       open_set.remove(current)
       closed_set.add(current)
       explored_states += 1
 
-      if current.status == STATUS_FINISHED or depth == _MAX_DEPTH:
-        best_state = current
-        best_score = f_score
-        break
-
-      for next_state in (ApproximateState(*s) for s in circuit.GetNextStates(current)):
+      next_states = [ApproximateState(*s) for s in circuit.GetNextStates(current, doomed=DOOMED_REMOVE)]
+      search.children[current] = next_states
+      for next_state, h in zip(next_states, heuristics(next_states)):
         if next_state in closed_set:
           continue
 
         tentative_gscore = g_score[current] + 1.
-        tentative_fscore = tentative_gscore + heuristic(next_state)
         if next_state not in open_set:
           pass
         elif tentative_gscore >= g_score[next_state]:  # Not better.
@@ -115,26 +154,22 @@ class AStarPlayer(ComputerPlayer):
           entry[-1] = _REMOVED  # Remove reference to state in queue.
 
         # It's pushed so update score maps :)
-        new_entry = [tentative_fscore, depth + 1, next_state]
-        open_set.add(next_state)
-        entry_finder[next_state] = new_entry
-        heapq.heappush(queue, new_entry)
-        g_score[next_state] = tentative_gscore
+        search.h_score[next_state] = h
+        search.Push(next_state, tentative_gscore, depth + 1)
         came_from[next_state] = current
     # We are done.
-    end_time = time.clock()
-    print('Best final state with score =', best_score, 'found in %.2f ms' % ((end_time - start_time) * 1000.))
-    print('Explored', explored_states, 'states.')
+    end_time = time.time()
+    print('Best final state with score =', best_score, 'found at depth', best_depth, 'in %.2f ms' % ((end_time - start_time) * 1000.))
+    print('Explored', explored_states, 'states (%.0f states/s).' % (explored_states / max(end_time - start_time, 1e-6)))
     if best_state is None:
-      return random.choice(xrange(len(self.allowed_moves)))
+      return 0  # No allowed moves.
 
     # Plot.
     if plot:
       plt.plot(circuit.raw_drivable_road.exterior.xy[0], circuit.raw_drivable_road.exterior.xy[1], 'k', linewidth=2)
       plt.plot(circuit.raw_drivable_road.interiors[0].xy[0], circuit.raw_drivable_road.interiors[0].xy[1], 'k', linewidth=2)
       plt.plot(circuit.starting_line.xy[0], circuit.starting_line.xy[1], 'k', linewidth=2)
-      valid_points = [p for p in circuit.analyzer.distances]
-      valid_points = np.array(valid_points).astype(float)
+      valid_points = circuit.analyzer.Points().astype(float)
       plt.scatter(valid_points[:, 0], valid_points[:, 1], c='gray', marker='+')
       for e, s in itertools.islice(came_from.iteritems(), 1000):  # Plot max 1000.
         plt.plot([s.xy[0], e.xy[0]], [s.xy[1], e.xy[1]], 'b+--', linewidth=2)
@@ -152,23 +187,74 @@ class AStarPlayer(ComputerPlayer):
       plt.show()
 
     current = best_state
-    if current in start_indices:
-      return start_indices[current]
-    while current in came_from:
+    while current not in start_indices:
       current = came_from[current]
-      if current in start_indices:
-        return start_indices[current]
-    return None
+    move_index = start_indices[current]
+    played = circuit.ToCompact(self.allowed_moves[move_index])
+    search.played = (played.key, played.round)
+    search.played_state = current
+    return move_index
+
+  def _Reroot(self, circuit, heuristics):
+    # Starts the search from the allowed moves. If the move chosen last turn was played, the part
+    # of the previous search below it is kept with costs shifted by one round. Other players only
+    # affect the allowed moves: the subtrees of moves that are no longer allowed are dropped and
+    # closed states that led to dropped states are expanded again.
+    roots = [ApproximateState(*s) for s in self.allowed_moves]
+    search = _Search()
+    previous = self.search
+    state = self.GetState()
+    if previous is not None and state is not None:
+      played = circuit.ToCompact(state)
+      if (played.key, played.round) != previous.played:
+        previous = None
+    else:
+      previous = None
+    # States are compared by identity along the tree (each state is the instance generated by its
+    # best parent). Matching roots are therefore replaced by the previous instances.
+    previous_roots = {}
+    if previous is not None:
+      previous_roots = dict((s, s) for s in previous.children.get(previous.played_state, ()))
+    stack = []
+    new_roots = []
+    for root in roots:
+      root = previous_roots.get(root, root)
+      if previous is not None and previous.came_from.get(root) is previous.played_state:
+        stack.append(root)
+      else:
+        new_roots.append(root)
+    root_set = set(roots)
+    while stack:
+      # Walk down the tree of best paths.
+      node = stack.pop()
+      search.g_score[node] = previous.g_score[node] - 1.
+      search.h_score[node] = previous.h_score[node]
+      search.depths[node] = previous.depths[node] - 1
+      if node not in previous.closed_set:
+        continue
+      search.closed_set.add(node)
+      search.children[node] = previous.children[node]
+      for child in previous.children[node]:
+        if previous.came_from.get(child) is node and child not in root_set:
+          search.came_from[child] = node
+          stack.append(child)
+    for node, children in search.children.items():
+      if any(child not in search.g_score and child not in root_set for child in children):
+        search.closed_set.remove(node)
+        del search.children[node]
+    for node in search.g_score.keys():
+      if node not in search.closed_set:
+        search.Push(node, search.g_score[node], search.depths[node])
+    for root, h in zip(new_roots, heuristics(new_roots)):
+      search.h_score[root] = h
+      search.Push(root, 1., 0)
+    return search
 
 
 def _Binarize(value, resolution):
   return int(value * resolution)
 
 
-def _ConvertLengthToRounds(value):
-  return value * _LENGTH_TO_LAP_FACTOR
-
-
 if __name__ == '__main__':
   parser = argparse.ArgumentParser()
   parser.add_argument("--circuit_directory", metavar='DIRECTORY', type=str, required=False, help="The directory where the circuit files are located.")
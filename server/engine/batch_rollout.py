@@ -0,0 +1,44 @@
+import numpy as np
+
+from circuit import DOOMED_MARK
+from circuit import STATUS_RUNNING
+
+# xrange compatibility.
+try:
+    xrange
+except NameError:
+    xrange = range
+
+
+# Score statistics of the rollouts started from each root state. Smaller scores are better.
+STATISTICS_DTYPE = np.dtype([('count', np.int64), ('mean', float), ('best', float)])
+
+
+def Rollouts(circuit, states, num_rollouts, max_depth, score_function, doomed=DOOMED_MARK):
+  # Plays num_rollouts random games of at most max_depth moves in lockstep. Each rollout starts
+  # from a root state drawn uniformly from states (a list of State or CompactState) and stops as
+  # soon as it finishes or crashes (see Circuit.GetRandomNextStatesBatch() for doomed).
+  # score_function maps an array of final states of dtype BATCH_STATE_DTYPE to their scores.
+  # Returns an array of dtype STATISTICS_DTYPE with one entry per root state.
+  roots = np.random.randint(len(states), size=num_rollouts)
+  batch = circuit.ToBatch(states)[roots]
+  running = np.flatnonzero(batch['status'] == STATUS_RUNNING)
+  for _ in xrange(max_depth):
+    if not len(running):
+      break
+    batch[running] = circuit.GetRandomNextStatesBatch(batch[running], doomed=doomed)
+    running = running[batch['status'][running] == STATUS_RUNNING]
+  return Statistics(roots, score_function(batch), len(states))
+
+
+def Statistics(roots, scores, num_roots):
+  # Aggregates the scores of rollouts started from the given roots. Roots without rollouts have
+  # an infinite mean and best score.
+  statistics = np.zeros(num_roots, dtype=STATISTICS_DTYPE)
+  statistics['count'] = np.bincount(roots, minlength=num_roots)
+  totals = np.bincount(roots, weights=scores, minlength=num_roots)
+  statistics['mean'] = np.where(statistics['count'] > 0, totals / np.maximum(statistics['count'], 1), np.inf)
+  best = np.full(num_roots, np.inf)
+  np.minimum.at(best, roots, scores)
+  statistics['best'] = best
+  return statistics
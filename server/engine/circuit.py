@@ -2,12 +2,14 @@ from __future__ import print_function
 
 import collections
 import copy
+import itertools
 import math
 import numpy as np
 import os
 from shapely import geometry
 from shapely import prepared
 import sys
+import threading
 
 # xrange compatibility.
 try:
@@ -26,10 +28,19 @@ class CircuitDoesNotExistError(Error):
 
 _MAX_NUM_LAPS = 10
 
+# Maximum number of entries of the OnRoad cache (per circuit). It is cleared when full.
+_ONROAD_CACHE_SIZE = 100000
+
 _PLUS_SPEED = 1
 _MINUS_SPEED = 1
 _TURN_ANGLE = math.pi / 4.0 + 0.0175  # Add small buffer of 1 degree.
 
+# Occupancy raster cell classes.
+_CELL_OUTSIDE = 0
+_CELL_INSIDE = 1
+_CELL_BOUNDARY = 2
+_RASTER_EPSILON = 1e-9
+
 _DIRECTIONS_WHEN_STOPPED = (
     np.array((-1, 0)),
     np.array((0, -1)),
@@ -39,50 +50,144 @@ _DIRECTIONS_WHEN_STOPPED = (
 )
 
 
+# Candidate moves returned by Circuit._GetNextPoints().
+_NEXT_POINT_DTYPE = np.dtype([
+    ('xy', int, (2,)), ('yaw', float), ('speed', float), ('status', np.int8), ('dlap', np.int8), ('dround', float)])
+
+# Outcome of a move from a given grid point (see Circuit._GetMoveOutcomes()). The table of outcomes
+# can be shared by processes without locking (see circuit_artifacts): a status of -1 means unknown,
+# so dlap and dround are always written before the status (see Circuit._StoreMoveOutcomes()).
+_MOVE_OUTCOME_DTYPE = np.dtype([('status', np.int8), ('dlap', np.int8), ('dround', float)])
+
+
 # Stores a player state along the circuit.
 STATUS_RUNNING = 0
 STATUS_CRASHED = 1
 STATUS_FINISHED = 2
 STATUS_DISCONNECTED = 3
 
+# What GetNextStates() does with running states that crash whatever their next moves (see
+# Circuit.ViableBatch()).
+DOOMED_KEEP = 'keep'
+DOOMED_MARK = 'mark'  # Their status is set to STATUS_CRASHED.
+DOOMED_REMOVE = 'remove'  # Crashed states are removed as well.
+
 
 # Player state.
 State = collections.namedtuple('State', ['xy', 'yaw', 'speed', 'round', 'lap', 'distance_left', 'status'])
 
+# Struct-of-arrays version of CompactState used by Circuit.GetNextStatesBatch().
+BATCH_STATE_DTYPE = np.dtype([
+    ('x', np.int32), ('y', np.int32), ('dx', np.int8), ('dy', np.int8), ('round', float), ('lap', np.int16),
+    ('distance_left', float), ('status', np.int8)])
+
+# Bit layout of CompactState.key: x and y use 16 bits each, the last move (dx, dy) and the lap
+# use 8 bits each and the status uses the remaining high bits. All fields are stored with an
+# offset to keep them positive.
+_PACK_COORD_OFFSET = 1 << 15
+_PACK_COORD_MASK = (1 << 16) - 1
+_PACK_BYTE_OFFSET = 1 << 7
+_PACK_BYTE_MASK = (1 << 8) - 1
+_PACK_Y_SHIFT = 16
+_PACK_DX_SHIFT = 32
+_PACK_DY_SHIFT = 40
+_PACK_LAP_SHIFT = 48
+_PACK_STATUS_SHIFT = 56
+
+
+class CompactState(object):
+  """Allocation-friendly alternative to State.
+
+  The position, the last move (which determines yaw and speed exactly), the lap and the status
+  are packed into a single integer (see PackState()). Hashing and equality only consider that
+  integer. Use Circuit.ToCompact() and Circuit.FromCompact() to convert from and to State.
+  """
+  __slots__ = ('key', 'round', 'distance_left')
+
+  def __init__(self, key, round, distance_left):
+    self.key = key
+    self.round = round
+    self.distance_left = distance_left
+
+  @property
+  def lap(self):
+    return ((self.key >> _PACK_LAP_SHIFT) & _PACK_BYTE_MASK) - _PACK_BYTE_OFFSET
+
+  @property
+  def status(self):
+    return self.key >> _PACK_STATUS_SHIFT
+
+  def __hash__(self):
+    return hash(self.key)
+
+  def __eq__(self, other):
+    return self.key == other.key
+
+  def __ne__(self, other):
+    return self.key != other.key
+
+  def __getstate__(self):
+    return (self.key, self.round, self.distance_left)
+
+  def __setstate__(self, state):
+    self.key, self.round, self.distance_left = state
+
+  def __repr__(self):
+    return 'CompactState(%r, round=%r, distance_left=%r)' % (UnpackState(self.key), self.round, self.distance_left)
+
+
+def PackState(x, y, dx, dy, lap, status):
+  return ((x + _PACK_COORD_OFFSET) |
+          ((y + _PACK_COORD_OFFSET) << _PACK_Y_SHIFT) |
+          ((dx + _PACK_BYTE_OFFSET) << _PACK_DX_SHIFT) |
+          ((dy + _PACK_BYTE_OFFSET) << _PACK_DY_SHIFT) |
+          ((lap + _PACK_BYTE_OFFSET) << _PACK_LAP_SHIFT) |
+          (status << _PACK_STATUS_SHIFT))
+
+
+def UnpackState(key):
+  # Returns (x, y, dx, dy, lap, status).
+  return ((key & _PACK_COORD_MASK) - _PACK_COORD_OFFSET,
+          ((key >> _PACK_Y_SHIFT) & _PACK_COORD_MASK) - _PACK_COORD_OFFSET,
+          ((key >> _PACK_DX_SHIFT) & _PACK_BYTE_MASK) - _PACK_BYTE_OFFSET,
+          ((key >> _PACK_DY_SHIFT) & _PACK_BYTE_MASK) - _PACK_BYTE_OFFSET,
+          ((key >> _PACK_LAP_SHIFT) & _PACK_BYTE_MASK) - _PACK_BYTE_OFFSET,
+          key >> _PACK_STATUS_SHIFT)
+
 
 class Circuit(object):
   circuit_data = None
+  circuit_files = {}  # Circuits found by SetPath() but not parsed yet.
+  circuit_files_lock = threading.Lock()
 
   @staticmethod
   def SetPath(path):
-    # List all circuit in the current folder and load them.
-    for filename in (os.path.join(path, f) for f in os.listdir(path) if os.path.isfile(os.path.join(path, f)) and f.endswith('.ckt')):
-      print('Loading:', filename)
-      with open(filename) as fp:
-        configuration = dict(l.strip().split(' = ', 1) for l in fp.readlines() if ' = ' in l)
-        name = configuration['name']
-        if name not in Circuit.circuit_data:
-          # Keep backward compatibility.
-          Circuit.circuit_data[name] = {
-              'circuit_name': name,
-              'circuit_grid_size': configuration['gridSize'] if 'gridSize' in configuration else 10,
-              'circuit_maximum_speed': configuration['maximumSpeed'],
-              'num_laps': int(configuration['numLaps']) if 'numLaps' in configuration else 1,
-              'circuit_starting_line': [int(n) for n in configuration['startingLine'].split(',')],
-              'circuit_inner_border': [int(n) for n in configuration['innerBorder'].split(',')],
-              'circuit_outer_border': [int(n) for n in configuration['outerBorder'].split(',')],
-          }
+    # Index all circuits in the given folder. Only their names are read: the circuits are parsed
+    # the first time they are needed (see GetData()).
+    for filename in sorted(os.path.join(path, f) for f in os.listdir(path) if os.path.isfile(os.path.join(path, f)) and f.endswith('.ckt')):
+      print('Indexing:', filename)
+      name = _ReadCircuitName(filename)
+      with Circuit.circuit_files_lock:
+        if name is not None and name not in Circuit.circuit_data and name not in Circuit.circuit_files:
+          Circuit.circuit_files[name] = filename
 
   @staticmethod
   def CircuitNames():
-    return Circuit.circuit_data.keys()
+    with Circuit.circuit_files_lock:
+      return list(Circuit.circuit_data.keys()) + list(Circuit.circuit_files.keys())
 
-  def __init__(self, name=None):
-    try:
-        data = Circuit.circuit_data[name if name else _DEFAULT_CIRCUIT_NAME]
-    except KeyError:
+  @staticmethod
+  def GetData(name):
+    with Circuit.circuit_files_lock:
+      if name in Circuit.circuit_files:
+        Circuit.circuit_data[name] = _ParseCircuitFile(Circuit.circuit_files.pop(name))
+      try:
+        return Circuit.circuit_data[name]
+      except KeyError:
         raise CircuitDoesNotExistError('%s does not exist.' % name)
 
+  def __init__(self, name=None, reference=False, compiled=None):
+    data = Circuit.GetData(name if name else _DEFAULT_CIRCUIT_NAME)
     self.name = data['circuit_name']
     self.maximum_speed = float(data['circuit_maximum_speed'])
     self.grid_size = float(data['circuit_grid_size'])
@@ -100,14 +205,20 @@ class Circuit(object):
         origin=self.origin)
     self.drivable_road_bounds = self.raw_drivable_road.bounds
     self.drivable_road = prepared.prep(self.raw_drivable_road)
+    # Occupancy raster used by OnRoad(). When reference is True, OnRoad() uses shapely directly.
+    self.reference = reference
     # Get valid starting points (list of numpy.array).
     self.starting_direction = self.GetStartingDirection()
-    self.starting_points = self.GetStartingPoints()
+    if compiled is None:
+      self._BuildRaster()
+      self.starting_points = self.GetStartingPoints()
+    else:
+      self._LoadCompiled(compiled)
+    # Candidate displacements for each (yaw, speed) pair.
+    self._BuildMoveTemplates()
     self.analyzer = None
-    # Caches for OnRoad, CrossingLine and _GetNextPoints.
+    # Cache for OnRoad. It is shared by all races on this circuit.
     self.onroad_cache = {}
-    self.crossing_cache = {}
-    self.next_points_cache = {}
 
   def __getstate__(self):
     # self.drivable_road cannot be pickled.
@@ -127,10 +238,131 @@ class Circuit(object):
     if key in self.onroad_cache:
       return self.onroad_cache[key]
     assert self.analyzer is not None, 'Call SetAnalyzer() before calling OnRoad().'
-    ret = self.analyzer.Contains(xy2) and self.drivable_road.contains(geometry.LineString([xy1, xy2]))
+    if self.reference:
+      ret = self.analyzer.Contains(xy2) and self._SegmentOnRoadReference(xy1, xy2)
+    else:
+      ret = self.analyzer.Contains(xy2) and self._SegmentOnRoad(xy1, xy2)
+    if len(self.onroad_cache) >= _ONROAD_CACHE_SIZE:
+      self.onroad_cache.clear()
     self.onroad_cache[key] = ret
     return ret
 
+  def _BuildRaster(self):
+    # Grid point (x, y) is stored at index (x - raster_origin[0], y - raster_origin[1]) of
+    # raster_points. Cell (i, j) of raster_cells is the unit square whose lower-left corner is
+    # grid point (i, j).
+    bounds = self.drivable_road_bounds
+    self.raster_origin = (int(math.floor(bounds[0])) - 1, int(math.floor(bounds[1])) - 1)
+    num_x = int(math.ceil(bounds[2])) + 2 - self.raster_origin[0]
+    num_y = int(math.ceil(bounds[3])) + 2 - self.raster_origin[1]
+    # Points strictly inside the road.
+    self.raster_points = np.zeros((num_x + 1, num_y + 1), dtype=bool)
+    for i in xrange(num_x + 1):
+      for j in xrange(num_y + 1):
+        self.raster_points[i, j] = self.drivable_road.contains(geometry.Point(self.raster_origin[0] + i, self.raster_origin[1] + j))
+    # Cells are outside the road, inside the road or touched by the road boundary.
+    edges = []
+    for ring in [self.raw_drivable_road.exterior] + list(self.raw_drivable_road.interiors):
+      coords = np.array(ring.coords)
+      edges.extend(tuple(e) for e in np.hstack((coords[:-1], coords[1:])).tolist())
+    self.raster_edges = edges
+    self.raster_cells = np.full((num_x, num_y), _CELL_OUTSIDE, dtype=np.int8)
+    self.raster_cell_edges = {}
+    for k, edge in enumerate(self.raster_edges):
+      segment = geometry.LineString([edge[:2], edge[2:]])
+      mini = int(math.floor(min(edge[0], edge[2]))) - self.raster_origin[0] - 1
+      maxi = int(math.floor(max(edge[0], edge[2]))) - self.raster_origin[0]
+      minj = int(math.floor(min(edge[1], edge[3]))) - self.raster_origin[1] - 1
+      maxj = int(math.floor(max(edge[1], edge[3]))) - self.raster_origin[1]
+      for i in xrange(max(mini, 0), min(maxi, num_x - 1) + 1):
+        for j in xrange(max(minj, 0), min(maxj, num_y - 1) + 1):
+          x, y = self.raster_origin[0] + i, self.raster_origin[1] + j
+          if segment.intersects(geometry.box(x, y, x + 1, y + 1)):
+            self.raster_cells[i, j] = _CELL_BOUNDARY
+            self.raster_cell_edges.setdefault((i, j), []).append(k)
+    for i in xrange(num_x):
+      for j in xrange(num_y):
+        if self.raster_cells[i, j] != _CELL_BOUNDARY:
+          # Cells not touching the boundary are either fully inside or fully outside.
+          x, y = self.raster_origin[0] + i, self.raster_origin[1] + j
+          if self.drivable_road.contains(geometry.Point(x + 0.5, y + 0.5)):
+            self.raster_cells[i, j] = _CELL_INSIDE
+
+  def Compile(self):
+    # Arrays holding the raster and the starting points. They are passed back to the constructor
+    # (see compiled_circuit) to skip the expensive geometric tests.
+    cell_keys = sorted(self.raster_cell_edges)
+    cell_edges = [self.raster_cell_edges[c] for c in cell_keys]
+    return {
+        'raster_origin': np.array(self.raster_origin, dtype=int),
+        'raster_points': self.raster_points,
+        'raster_cells': self.raster_cells,
+        'raster_edges': np.array(self.raster_edges, dtype=float).reshape(-1, 4),
+        'raster_cell_keys': np.array(cell_keys, dtype=int).reshape(-1, 2),
+        'raster_cell_offsets': np.cumsum([0] + [len(e) for e in cell_edges]).astype(int),
+        'raster_cell_edges': np.array(sum(cell_edges, []), dtype=int),
+        # Stored in iteration order so that the rebuilt set iterates identically.
+        'starting_points': np.array(list(self.starting_points), dtype=int).reshape(-1, 2),
+    }
+
+  def _LoadCompiled(self, compiled):
+    self.raster_origin = tuple(compiled['raster_origin'].tolist())
+    self.raster_points = compiled['raster_points']
+    self.raster_cells = compiled['raster_cells']
+    self.raster_edges = [tuple(e) for e in compiled['raster_edges'].tolist()]
+    offsets = compiled['raster_cell_offsets'].tolist()
+    edges = compiled['raster_cell_edges'].tolist()
+    self.raster_cell_edges = {}
+    for k, c in enumerate(compiled['raster_cell_keys'].tolist()):
+      self.raster_cell_edges[tuple(c)] = edges[offsets[k]:offsets[k + 1]]
+    self.starting_points = set(tuple(p) for p in compiled['starting_points'].tolist())
+
+  def _SegmentOnRoad(self, xy1, xy2):
+    # Exact test for segments between grid points. Only cells touched by the road boundary need
+    # to look at the polygon edges.
+    ox, oy = self.raster_origin
+    x1, y1 = int(xy1[0]) - ox, int(xy1[1]) - oy
+    x2, y2 = int(xy2[0]) - ox, int(xy2[1]) - oy
+    num_x, num_y = self.raster_cells.shape
+    boundary_cells = []
+    for dx, dy in _SupercoverOffsets(x2 - x1, y2 - y1):
+      i, j = x1 + dx, y1 + dy
+      if i < 0 or j < 0 or i >= num_x or j >= num_y:
+        return False
+      cell = self.raster_cells.item(i, j)
+      if cell == _CELL_OUTSIDE:
+        return False
+      if cell == _CELL_BOUNDARY:
+        boundary_cells.append((i, j))
+    if not boundary_cells:
+      return True
+    edge_indices = set()
+    for c in boundary_cells:
+      edge_indices.update(self.raster_cell_edges[c])
+    crossing, touching = _SegmentCrossesEdges(xy1, xy2, [self.raster_edges[k] for k in edge_indices])
+    if crossing:
+      return False
+    if touching:
+      # Rare degenerate case (segment going through a vertex or along an edge).
+      return self._SegmentOnRoadReference(xy1, xy2)
+    # The segment does not meet the boundary: it is either fully inside or fully outside.
+    return self.raster_points.item(x2, y2)
+
+  def _SegmentOnRoadReference(self, xy1, xy2):
+    return self.drivable_road.contains(geometry.LineString([xy1, xy2]))
+
+  def CacheStats(self):
+    filled = int(np.count_nonzero(self.move_outcomes['status'] >= 0))
+    hits, misses = self.move_outcome_counts.tolist()
+    return {
+        'onroad': {'size': len(self.onroad_cache), 'capacity': _ONROAD_CACHE_SIZE},
+        # This table has a fixed size and never evicts.
+        'move_outcomes': {
+            'size': filled, 'capacity': self.move_outcomes.size, 'bytes': self.move_outcomes.nbytes,
+            'hits': hits, 'misses': misses, 'hit_rate': float(hits) / (hits + misses) if hits + misses else 0.,
+        },
+    }
+
   def SetAnalyzer(self, analyzer):
     self.analyzer = analyzer
 
@@ -159,59 +391,186 @@ class Circuit(object):
 
   # Crossing excludes the xy1.
   def CrossingLine(self, xy1, xy2):
-    key = (xy1[0], xy1[1], xy2[0], xy2[1])
-    if key in self.crossing_cache:
-      return self.crossing_cache[key]
-    i = self.starting_line.intersection(geometry.LineString([xy1, xy2]))
-    # There must be a single intersection point.
-    if not isinstance(i, geometry.Point):
-      ret = (0, 0)
-    else:
-      # Check distance between xy1 and intersection.
-      i = np.array(i.coords[0])
-      # Check direction of crossing.
-      v = xy2 - xy1
-      if v.dot(self.starting_direction) > 0:
-        d = np.linalg.norm(i - xy1)
-        if d < 0.5:  # Don't count if only the starting point crosses.
-          ret = (0, 0)
-        else:
-          ret = (1, d / np.linalg.norm(v))  # We known ||v|| > 0
-      else:  # This hysteresis is needed to avoid double counting.
-        d = np.linalg.norm(i - xy2)
-        if d < 0.5:  # Don't count if only the end point crosses.
-          ret = (0, 0)
-        else:
-          ret = (-1, 0)
-    self.crossing_cache[key] = ret
-    return ret
+    dlap, dround = _CrossLine(self.starting_line.coords, self.starting_direction, xy1[0], xy1[1], xy2[0], xy2[1])
+    return int(dlap), float(dround)
+
+  def CrossingLines(self, x1, y1, x2, y2):
+    # Vectorized version of CrossingLine() for arrays of moves.
+    return _CrossLine(self.starting_line.coords, self.starting_direction, x1, y1, x2, y2)
+
+  def MovesMayBeOnRoad(self, x, y):
+    # Necessary condition for OnRoad() to hold for all moves (see self.moves) from the grid points
+    # (x, y): the segments do not touch any raster cell that is fully outside the road. Returns
+    # an array of shape (len(x), len(self.moves)). End points are not checked.
+    offsets = [_SupercoverOffsets(dx, dy) for dx, dy in self.moves]
+    starts = np.cumsum([0] + [len(o) for o in offsets[:-1]])
+    ox, oy = np.array(sum(offsets, ())).T
+    i = np.asarray(x, dtype=int)[:, None] - self.raster_origin[0] + ox
+    j = np.asarray(y, dtype=int)[:, None] - self.raster_origin[1] + oy
+    num_x, num_y = self.raster_cells.shape
+    inside = (i >= 0) & (j >= 0) & (i < num_x) & (j < num_y)
+    allowed = inside & (self.raster_cells[np.where(inside, i, 0), np.where(inside, j, 0)] != _CELL_OUTSIDE)
+    return np.logical_and.reduceat(allowed, starts, axis=1)
+
+  def SegmentsOnRoad(self, x1, y1, x2, y2):
+    # Exact test of the segments between grid points (x1, y1) and (x2, y2) (arrays of the same
+    # size). Unlike OnRoad(), end points are not checked and results are not cached.
+    segment_on_road = self._SegmentOnRoadReference if self.reference else self._SegmentOnRoad
+    return np.array([segment_on_road(xy1, xy2) for xy1, xy2 in zip(
+        zip(np.asarray(x1).tolist(), np.asarray(y1).tolist()), zip(np.asarray(x2).tolist(), np.asarray(y2).tolist()))], dtype=bool)
+
+  def RoundsToGo(self, state):
+    # Lower bound on the number of rounds needed to finish the race from a State or CompactState
+    # (see CircuitAnalyzer.RoundsToGo()).
+    return float(self.RoundsToGoBatch(self.ToBatch([state]))[0])
+
+  def RoundsToGoBatch(self, states):
+    # Vectorized version of RoundsToGo() for an array of dtype BATCH_STATE_DTYPE. Crashed states
+    # get infinity and finished states 0.
+    assert self.analyzer is not None, 'Call SetAnalyzer() before calling RoundsToGoBatch().'
+    rounds = self.analyzer.RoundsToGo(states['x'], states['y'], self._MoveIndices(states), self.num_laps - states['lap'].astype(int))
+    rounds[states['status'] == STATUS_FINISHED] = 0.
+    rounds[states['status'] == STATUS_CRASHED] = np.inf
+    return rounds
+
+  def ViableBatch(self, states):
+    # Whether each state of an array of dtype BATCH_STATE_DTYPE may avoid crashing (see
+    # CircuitAnalyzer.Viable()). Only crashed and doomed running states are not viable.
+    assert self.analyzer is not None, 'Call SetAnalyzer() before calling ViableBatch().'
+    running = states['status'] == STATUS_RUNNING
+    viable = states['status'] != STATUS_CRASHED
+    viable[running] = self.analyzer.Viable(states['x'][running], states['y'][running], self._MoveIndices(states[running]))
+    return viable
+
+  def _MoveIndices(self, states):
+    # Index of the last move of each state in self.moves (len(self.moves) when stopped and -1 for
+    # unknown moves).
+    dx = states['dx'].astype(int)
+    dy = states['dy'].astype(int)
+    max_step = (self.move_lookup.shape[0] - 1) // 2
+    known = (np.abs(dx) <= max_step) & (np.abs(dy) <= max_step)
+    moves = np.where(known, self.move_lookup[np.where(known, dx, 0) + max_step, np.where(known, dy, 0) + max_step], -1)
+    moves[(dx == 0) & (dy == 0)] = len(self.moves)
+    return moves
+
+  def _BuildMoveTemplates(self):
+    # The legal displacements only depend on the current yaw and speed, which are themselves fully
+    # determined by the previous displacement. Templates are keyed by that displacement.
+    max_step = int(math.floor(self.maximum_speed))
+    self.moves = []
+    for dx in xrange(-max_step, max_step + 1):
+      for dy in xrange(-max_step, max_step + 1):
+        if 0 < dx * dx + dy * dy <= self.maximum_speed * self.maximum_speed:
+          self.moves.append((dx, dy))
+    self.move_indices = dict((d, i) for i, d in enumerate(self.moves))
+    self.move_templates = {}
+    for dx, dy in self.moves:
+      speed = math.sqrt(dx * dx + dy * dy)
+      yaw = math.atan2(dy, dx)
+      self.move_templates[(dx, dy)] = self._BuildMoveTemplate(yaw, speed)
+    # Flat version of the templates for GetNextStatesBatch(). The template of move k holds the moves
+    # template_moves[template_offsets[k]:template_offsets[k + 1]] (indices into self.moves).
+    self.moves_array = np.array(self.moves, dtype=int)
+    self.move_lookup = np.full((2 * max_step + 1, 2 * max_step + 1), -1, dtype=int)
+    for k, (dx, dy) in enumerate(self.moves):
+      self.move_lookup[dx + max_step, dy + max_step] = k
+    template_sizes = [len(self.move_templates[d].moves) for d in self.moves]
+    self.template_offsets = np.cumsum([0] + template_sizes).astype(int)
+    self.template_moves = np.concatenate([self.move_templates[d].indices for d in self.moves]).astype(int)
+    # Outcome of each move from each grid point of the raster (filled lazily, a status of -1 means
+    # unknown). Its size only depends on the circuit.
+    self.move_outcomes = np.zeros((self.raster_points.size, len(self.moves)), dtype=_MOVE_OUTCOME_DTYPE)
+    self.move_outcomes['status'] = -1
+    # Number of lookups in move_outcomes that found a known (hits) or unknown (misses) outcome.
+    # When the table is shared (see circuit_artifacts), so are the counts, and concurrent updates
+    # may be lost.
+    self.move_outcome_counts = np.zeros(2, dtype=np.int64)
+
+  def _RestoreMoveTemplates(self):
+    # Rebuilds the templates from their flat version (see circuit_artifacts.Attach()).
+    self.moves = [tuple(d) for d in self.moves_array.tolist()]
+    self.move_indices = dict((d, i) for i, d in enumerate(self.moves))
+    self.move_templates = {}
+    for k, (dx, dy) in enumerate(self.moves):
+      indices = np.array(self.template_moves[self.template_offsets[k]:self.template_offsets[k + 1]])
+      moves = self.moves_array[indices]
+      yaws = np.arctan2(moves[:, 1], moves[:, 0])
+      speeds = np.sqrt(moves[:, 0] * moves[:, 0] + moves[:, 1] * moves[:, 1])
+      self.move_templates[(dx, dy)] = _MoveTemplate(math.atan2(dy, dx), math.sqrt(dx * dx + dy * dy), moves, yaws, speeds, indices)
+
+  def _BuildMoveTemplate(self, yaw, speed):
+    max_speed = min(self.maximum_speed, speed + _PLUS_SPEED)
+    min_speed = max(0.5, speed - _MINUS_SPEED)  # Cars cannot stop.
+    moves, yaws, speeds = _ScoreSearchBox(yaw, min_speed, max_speed)
+    indices = np.array([self.move_indices.get((dx, dy), -1) for dx, dy in moves.tolist()], dtype=int)
+    return _MoveTemplate(yaw, speed, moves, yaws, speeds, indices)
+
+  def _GetMoveTemplate(self, yaw, speed):
+    template = self.move_templates.get(_TemplateKey(yaw, speed))
+    if template is not None and template.yaw == yaw and template.speed == speed:
+      return template
+    # Only happens for states that were not produced by GetNextStates().
+    return self._BuildMoveTemplate(yaw, speed)
+
+  def _GetMoveOutcomes(self, xy, template):
+    # Returns the status, dlap and dround of all moves of the template from xy (see OnRoad() and
+    # CrossingLine()).
+    xy = np.asarray(xy)
+    i = int(xy[0]) - self.raster_origin[0]
+    j = int(xy[1]) - self.raster_origin[1]
+    num_x, num_y = self.raster_points.shape
+    # Reference circuits never use the table of outcomes, which may be shared with other circuits.
+    if self.reference or i < 0 or j < 0 or i >= num_x or j >= num_y or not template.indexed:
+      return self._ComputeMoveOutcomes(xy[0], xy[1], xy[0] + template.moves[:, 0], xy[1] + template.moves[:, 1])
+    outcomes = self.move_outcomes[i * num_y + j][template.indices]
+    unknown = np.flatnonzero(outcomes['status'] < 0)
+    self._CountMoveOutcomes(len(outcomes), len(unknown))
+    if len(unknown):
+      moves = template.moves[unknown]
+      outcomes[unknown] = self._ComputeMoveOutcomes(xy[0], xy[1], xy[0] + moves[:, 0], xy[1] + moves[:, 1])
+      self._StoreMoveOutcomes(i * num_y + j, template.indices[unknown], outcomes[unknown])
+    return outcomes
+
+  def _CountMoveOutcomes(self, num_lookups, num_unknown):
+    self.move_outcome_counts += (num_lookups - num_unknown, num_unknown)
+
+  def _StoreMoveOutcomes(self, points, moves, outcomes):
+    # The status is written last so that other processes never see a known status with missing
+    # dlap or dround (see _MOVE_OUTCOME_DTYPE).
+    self.move_outcomes['dlap'][points, moves] = outcomes['dlap']
+    self.move_outcomes['dround'][points, moves] = outcomes['dround']
+    self.move_outcomes['status'][points, moves] = outcomes['status']
+
+  def _ComputeMoveOutcomes(self, x1, y1, x2, y2):
+    # x1 and y1 can either be scalars or arrays of the same size as x2 and y2.
+    outcomes = np.zeros(len(x2), dtype=_MOVE_OUTCOME_DTYPE)
+    x1, y1 = np.broadcast_to(x1, x2.shape), np.broadcast_to(y1, y2.shape)
+    segment_on_road = self._SegmentOnRoadReference if self.reference else self._SegmentOnRoad
+    outcomes['status'] = [
+        STATUS_RUNNING if self.analyzer.Contains(xy2) and segment_on_road(xy1, xy2) else STATUS_CRASHED
+        for xy1, xy2 in zip(zip(x1.tolist(), y1.tolist()), zip(x2.tolist(), y2.tolist()))]
+    outcomes['dlap'], outcomes['dround'] = self.CrossingLines(x1, y1, x2, y2)
+    return outcomes
 
   def _GetNextPoints(self, current_state):
-    key = (current_state.xy[0], current_state.xy[1], current_state.yaw, current_state.speed)
-    if key in self.next_points_cache:
-      return self.next_points_cache[key]
-    max_speed = min(self.maximum_speed, current_state.speed + _PLUS_SPEED)
-    min_speed = max(0.5, current_state.speed - _MINUS_SPEED)  # Cars cannot stop.
-    minx, miny, maxx, maxy = _BuildSearchBox(current_state, min_speed, max_speed)
-    next_points = []
-    for x in range(minx, maxx + 1):
-      for y in range(miny, maxy + 1):
-        xy = np.array((x, y))
-        d = xy - current_state.xy
-        new_yaw = math.atan2(d[1], d[0])
-        new_speed = np.linalg.norm(d)
-        da = _NormalizeAngle(new_yaw - current_state.yaw)
-        if ((new_speed == 0 or (da <= _TURN_ANGLE and da >= -_TURN_ANGLE)) and new_speed <= max_speed and new_speed >= min_speed):
-          # New status.
-          new_status = STATUS_RUNNING if self.OnRoad(current_state.xy, xy) else STATUS_CRASHED
-          # Check if we cross the line and in which direction.
-          dlap, dround = self.CrossingLine(current_state.xy, xy)
-          next_points.append((xy, new_yaw, new_speed, new_status, dlap, dround))
-    self.next_points_cache[key] = next_points
+    template = self._GetMoveTemplate(current_state.yaw, current_state.speed)
+    outcomes = self._GetMoveOutcomes(current_state.xy, template)
+    next_points = template.points.copy()
+    next_points['xy'] += current_state.xy
+    next_points['status'] = outcomes['status']
+    next_points['dlap'] = outcomes['dlap']
+    next_points['dround'] = outcomes['dround']
     return next_points
 
-  def GetNextStates(self, current_state=None, remove=()):
+  def GetNextStates(self, current_state=None, remove=(), compact=False, doomed=DOOMED_KEEP):
     assert self.analyzer is not None, 'Call SetAnalyzer() before calling GetNextStates().'
+    if compact or isinstance(current_state, CompactState):
+      if current_state is not None and not isinstance(current_state, CompactState):
+        current_state = self.ToCompact(current_state)
+      next_states = self._GetNextCompactStates(current_state, remove, doomed)
+      return next_states if compact else [self.FromCompact(s) for s in next_states]
+    if doomed != DOOMED_KEEP:
+      return self._HandleDoomedStates(self.GetNextStates(current_state, remove), doomed)
     # Start of race.
     next_states = []
     if current_state is None:
@@ -254,8 +613,10 @@ class Circuit(object):
         next_states.append(State(xy, new_yaw, new_speed, new_round, new_lap, new_distance, new_status))
       return next_states
     else:
-      for next_point in self._GetNextPoints(current_state):
-        xy, new_yaw, new_speed, new_status, dlap, dround = next_point
+      next_points = self._GetNextPoints(current_state)
+      for xy, new_yaw, new_speed, new_status, dlap, dround in zip(
+          next_points['xy'], next_points['yaw'].tolist(), next_points['speed'].tolist(),
+          next_points['status'].tolist(), next_points['dlap'].tolist(), next_points['dround'].tolist()):
         if tuple(xy) in remove:
           continue
         new_lap = current_state.lap + dlap
@@ -269,6 +630,200 @@ class Circuit(object):
         next_states.append(State(xy, new_yaw, new_speed, new_round, new_lap, new_distance, new_status))
       return next_states
 
+  def _HandleDoomedStates(self, states, doomed):
+    # Marks or removes the doomed states of a list of State.
+    if not states:
+      return states
+    viable = self.ViableBatch(self.ToBatch(states)).tolist()
+    if doomed == DOOMED_REMOVE:
+      return [s for s, v in zip(states, viable) if v]
+    return [s if v else s._replace(status=STATUS_CRASHED) for s, v in zip(states, viable)]
+
+  def _GetNextCompactStates(self, current_state, remove, doomed):
+    # Same as GetNextStates() but works on CompactState only.
+    if current_state is None:
+      return [self.ToCompact(s) for s in self.GetNextStates(remove=remove, doomed=doomed)]
+    x, y, dx, dy, lap, status = UnpackState(current_state.key)
+    if status != STATUS_RUNNING:
+      return []
+    if current_state.round == 1 or (dx == 0 and dy == 0):
+      # Rare cases are handled by GetNextStates().
+      return [self.ToCompact(s) for s in self.GetNextStates(self.FromCompact(current_state), remove=remove, doomed=doomed)]
+    template = self.move_templates.get((dx, dy))
+    if template is None:
+      return [self.ToCompact(s) for s in self.GetNextStates(self.FromCompact(current_state), remove=remove, doomed=doomed)]
+    outcomes = self._GetMoveOutcomes((x, y), template)
+    if doomed == DOOMED_KEEP:
+      viable = itertools.repeat(True)
+    else:
+      viable = self.analyzer.Viable(x + template.moves[:, 0], y + template.moves[:, 1], template.indices).tolist()
+    next_states = []
+    for (mx, my), new_status, dlap, dround, move_viable in zip(
+        template.moves.tolist(), outcomes['status'].tolist(), outcomes['dlap'].tolist(), outcomes['dround'].tolist(), viable):
+      xy = (x + mx, y + my)
+      if xy in remove:
+        continue
+      new_lap = lap + dlap
+      if new_lap == self.num_laps:
+        new_round = current_state.round + dround
+        new_status = STATUS_FINISHED if new_status == STATUS_RUNNING else new_status
+        new_distance = 0. if new_status == STATUS_FINISHED else current_state.distance_left
+      else:
+        new_round = current_state.round + 1
+        new_distance = self.analyzer.Distance(xy) if new_status == STATUS_RUNNING else current_state.distance_left
+      if new_status == STATUS_RUNNING and not move_viable:
+        new_status = STATUS_CRASHED
+      if new_status == STATUS_CRASHED and doomed == DOOMED_REMOVE:
+        continue
+      next_states.append(CompactState(PackState(xy[0], xy[1], mx, my, new_lap, new_status), new_round, new_distance))
+    return next_states
+
+  def GetNextStatesBatch(self, states, doomed=DOOMED_KEEP):
+    # Expands many states at once. states is an array of dtype BATCH_STATE_DTYPE (see ToBatch()).
+    # Returns the successors as a single array of the same dtype and offsets such that the
+    # successors of states[i] are next_states[offsets[i]:offsets[i + 1]]. Unlike GetNextStates(),
+    # no position can be removed. Doomed successors are handled as in GetNextStates().
+    assert self.analyzer is not None, 'Call SetAnalyzer() before calling GetNextStatesBatch().'
+    num_states = len(states)
+    move, regular = self._BatchMoves(states)
+    running = states['status'] == STATUS_RUNNING
+    # Successors of regular states are computed in bulk from the flat templates.
+    parent_indices = np.flatnonzero(regular)
+    counts = self.template_offsets[move[parent_indices] + 1] - self.template_offsets[move[parent_indices]]
+    parents = np.repeat(parent_indices, counts)
+    first_child = np.cumsum(counts) - counts
+    entries = np.repeat(self.template_offsets[move[parent_indices]] - first_child, counts) + np.arange(len(parents))
+    next_states = self._ChildStatesBatch(states, parents, self.template_moves[entries])
+    # Remaining running states (start of the race or unusual moves) are expanded one by one.
+    special_indices = np.flatnonzero(running & ~regular)
+    if len(special_indices):
+      special_parents = []
+      special_states = []
+      for k, state in zip(special_indices, self.FromBatch(states[special_indices])):
+        successors = self.GetNextStates(state, compact=True)
+        special_parents.extend([k] * len(successors))
+        special_states.extend(successors)
+      parents = np.concatenate((parents, np.array(special_parents, dtype=int)))
+      next_states = np.concatenate((next_states, self.ToBatch(special_states)))
+      order = np.argsort(parents, kind='mergesort')
+      parents = parents[order]
+      next_states = next_states[order]
+    if doomed != DOOMED_KEEP:
+      viable = self.ViableBatch(next_states)
+      if doomed == DOOMED_REMOVE:
+        parents = parents[viable]
+        next_states = next_states[viable]
+      else:
+        next_states['status'][~viable] = STATUS_CRASHED
+    offsets = np.concatenate(([0], np.cumsum(np.bincount(parents, minlength=num_states)))).astype(int)
+    return next_states, offsets
+
+  def GetRandomNextStatesBatch(self, states, doomed=DOOMED_KEEP):
+    # Replaces each running state by one of its successors (see GetNextStatesBatch()) drawn
+    # uniformly at random. Finished and crashed states are returned unchanged, and so are running
+    # states without successors. Doomed successors can be kept or marked as crashed (but not
+    # removed).
+    assert self.analyzer is not None, 'Call SetAnalyzer() before calling GetRandomNextStatesBatch().'
+    assert doomed != DOOMED_REMOVE, 'Doomed successors cannot be removed from random successors.'
+    move, regular = self._BatchMoves(states)
+    next_states = states.copy()
+    # A random entry of each template, without expanding the other successors.
+    parents = np.flatnonzero(regular)
+    begin = self.template_offsets[move[parents]]
+    counts = self.template_offsets[move[parents] + 1] - begin
+    entries = begin + (np.random.random_sample(len(parents)) * counts).astype(int)
+    next_states[parents] = self._ChildStatesBatch(states, parents, self.template_moves[entries])
+    special_indices = np.flatnonzero((states['status'] == STATUS_RUNNING) & ~regular)
+    for k, state in zip(special_indices, self.FromBatch(states[special_indices])):
+      successors = self.GetNextStates(state, compact=True)
+      if successors:
+        next_states[k] = self.ToBatch([successors[np.random.randint(len(successors))]])[0]
+    if doomed == DOOMED_MARK:
+      next_states['status'][~self.ViableBatch(next_states)] = STATUS_CRASHED
+    return next_states
+
+  def _BatchMoves(self, states):
+    # Returns the index of the last move of each state (-1 if unknown) and whether the successors
+    # of each state can be computed from the templates.
+    x = states['x'].astype(int)
+    y = states['y'].astype(int)
+    max_step = (self.move_lookup.shape[0] - 1) // 2
+    num_x, num_y = self.raster_points.shape
+    i = x - self.raster_origin[0]
+    j = y - self.raster_origin[1]
+    move = np.full(len(states), -1, dtype=int)
+    known = (states['status'] == STATUS_RUNNING) & (np.abs(states['dx']) <= max_step) & (np.abs(states['dy']) <= max_step)
+    move[known] = self.move_lookup[states['dx'][known] + max_step, states['dy'][known] + max_step]
+    regular = known & (move >= 0) & (states['round'] != 1) & (i >= 0) & (j >= 0) & (i < num_x) & (j < num_y)
+    return move, regular
+
+  def _ChildStatesBatch(self, states, parents, child_moves):
+    # Returns the states reached by playing child_moves[k] from states[parents[k]]. The parents
+    # must be regular (see _BatchMoves()).
+    x = states['x'][parents].astype(int)
+    y = states['y'][parents].astype(int)
+    num_y = self.raster_points.shape[1]
+    points = (x - self.raster_origin[0]) * num_y + (y - self.raster_origin[1])
+    child_x = x + self.moves_array[child_moves, 0]
+    child_y = y + self.moves_array[child_moves, 1]
+    if self.reference:
+      outcomes = self._ComputeMoveOutcomes(x, y, child_x, child_y)
+    else:
+      outcomes = self.move_outcomes[points, child_moves]
+      self._CountMoveOutcomes(len(outcomes), np.count_nonzero(outcomes['status'] < 0))
+    unknown = np.flatnonzero(outcomes['status'] < 0)
+    if len(unknown):
+      outcomes[unknown] = self._ComputeMoveOutcomes(x[unknown], y[unknown], child_x[unknown], child_y[unknown])
+      self._StoreMoveOutcomes(points[unknown], child_moves[unknown], outcomes[unknown])
+    next_states = np.zeros(len(parents), dtype=BATCH_STATE_DTYPE)
+    next_states['x'] = child_x
+    next_states['y'] = child_y
+    next_states['dx'] = self.moves_array[child_moves, 0]
+    next_states['dy'] = self.moves_array[child_moves, 1]
+    next_states['lap'] = states['lap'][parents] + outcomes['dlap']
+    finished = next_states['lap'] == self.num_laps
+    status = outcomes['status']
+    next_states['round'] = states['round'][parents] + np.where(finished, outcomes['dround'], 1.)
+    next_states['status'] = np.where(finished & (status == STATUS_RUNNING), STATUS_FINISHED, status)
+    distance_left = states['distance_left'][parents]
+    update = ~finished & (status == STATUS_RUNNING)
+    distance_left[update] = self.analyzer.Distances(child_x[update], child_y[update])
+    distance_left[finished & (status == STATUS_RUNNING)] = 0.
+    next_states['distance_left'] = distance_left
+    return next_states
+
+  def ToBatch(self, states):
+    # Converts a list of State or CompactState to an array of dtype BATCH_STATE_DTYPE.
+    batch = np.zeros(len(states), dtype=BATCH_STATE_DTYPE)
+    for k, state in enumerate(states):
+      if not isinstance(state, CompactState):
+        state = self.ToCompact(state)
+      x, y, dx, dy, lap, status = UnpackState(state.key)
+      batch[k] = (x, y, dx, dy, state.round, lap, state.distance_left, status)
+    return batch
+
+  def FromBatch(self, batch):
+    # Converts an array of dtype BATCH_STATE_DTYPE to a list of CompactState.
+    return [CompactState(PackState(x, y, dx, dy, lap, status), r, distance_left)
+            for x, y, dx, dy, r, lap, distance_left, status in batch.tolist()]
+
+  def ToCompact(self, state):
+    if state.speed == 0:
+      dx, dy = 0, 0
+    else:
+      dx, dy = _TemplateKey(state.yaw, state.speed)
+    return CompactState(PackState(int(state.xy[0]), int(state.xy[1]), dx, dy, state.lap, state.status), state.round, state.distance_left)
+
+  def FromCompact(self, compact_state):
+    x, y, dx, dy, lap, status = UnpackState(compact_state.key)
+    if dx == 0 and dy == 0:
+      # Only happens at the start of the race.
+      d = self.starting_direction
+      yaw, speed = math.atan2(d[1], d[0]), 0
+    else:
+      yaw, speed = math.atan2(dy, dx), math.sqrt(dx * dx + dy * dy)
+    return State(np.array((x, y)), yaw, speed, compact_state.round, lap, compact_state.distance_left, status)
+
   def ScaleStates(self, states):
     scaled_states = []
     for state in states:
@@ -302,19 +857,145 @@ class Circuit(object):
     sys.stdout.flush()
 
 
-def _BuildSearchBox(state, min_speed, max_speed):
+def _BuildSearchBox(yaw, min_speed, max_speed):
   minx = min_speed
   maxx = max_speed
   maxy = math.sin(_TURN_ANGLE) * maxx
   miny = -maxy
   # Rotate.
   box = np.array([[minx, miny], [minx, maxy], [maxx, miny], [maxx, maxy]])
-  rotation = np.array([[math.cos(state.yaw), math.sin(state.yaw)], [-math.sin(state.yaw), math.cos(state.yaw)]])
-  rbox = box.dot(rotation).astype(int) + state.xy
-  # Get bounds.
+  rotation = np.array([[math.cos(yaw), math.sin(yaw)], [-math.sin(yaw), math.cos(yaw)]])
+  rbox = box.dot(rotation).astype(int)
+  # Get bounds (relative to the current position).
   return (np.min(rbox[:, 0]), np.min(rbox[:, 1]), np.max(rbox[:, 0]), np.max(rbox[:, 1]))
 
 
+def _ScoreSearchBox(yaw, min_speed, max_speed):
+  # Scores all cells of the search box at once. Returns the displacements that satisfy the turn
+  # angle and speed constraints, with their yaw and speed.
+  minx, miny, maxx, maxy = _BuildSearchBox(yaw, min_speed, max_speed)
+  x, y = np.meshgrid(np.arange(minx, maxx + 1), np.arange(miny, maxy + 1), indexing='ij')
+  d = np.column_stack((x.ravel(), y.ravel()))
+  new_yaw = np.arctan2(d[:, 1], d[:, 0])
+  new_speed = np.sqrt(d[:, 0] * d[:, 0] + d[:, 1] * d[:, 1])
+  # Both yaws are within [-pi, pi], so a single wrap normalizes the difference.
+  da = new_yaw - yaw
+  da = np.where(da > math.pi, da - 2. * math.pi, np.where(da < -math.pi, da + 2. * math.pi, da))
+  valid = (((new_speed == 0) | ((da <= _TURN_ANGLE) & (da >= -_TURN_ANGLE))) &
+           (new_speed <= max_speed) & (new_speed >= min_speed))
+  return d[valid], new_yaw[valid], new_speed[valid]
+
+
+class _MoveTemplate(object):
+  # Candidate moves from a given (yaw, speed), relative to the current position. indices refers to
+  # Circuit.moves.
+
+  def __init__(self, yaw, speed, moves, yaws, speeds, indices):
+    self.yaw = yaw
+    self.speed = speed
+    self.moves = moves
+    self.yaws = yaws
+    self.speeds = speeds
+    self.indices = indices
+    self.indexed = bool(np.all(indices >= 0))
+    # Prototype for Circuit._GetNextPoints().
+    self.points = np.zeros(len(moves), dtype=_NEXT_POINT_DTYPE)
+    self.points['xy'] = moves
+    self.points['yaw'] = yaws
+    self.points['speed'] = speeds
+
+
+def _TemplateKey(yaw, speed):
+  return (int(round(speed * math.cos(yaw))), int(round(speed * math.sin(yaw))))
+
+
+def _CrossLine(line, direction, x1, y1, x2, y2):
+  # Returns the change of lap and the fraction of the move done before crossing the line for
+  # moves from (x1, y1) to (x2, y2). Works on scalars and on arrays of moves.
+  (ax, ay), (bx, by) = line[0], line[1]
+  sx, sy = bx - ax, by - ay
+  vx, vy = np.subtract(x2, x1, dtype=float), np.subtract(y2, y1, dtype=float)
+  wx, wy = ax - np.asarray(x1, dtype=float), ay - np.asarray(y1, dtype=float)
+  denominator = vx * sy - vy * sx
+  numerator_t = wx * sy - wy * sx
+  numerator_u = wx * vy - wy * vx
+  with np.errstate(divide='ignore', invalid='ignore'):
+    t = numerator_t / denominator
+    u = numerator_u / denominator
+    crossing = (denominator != 0.) & (t >= 0.) & (t <= 1.) & (u >= 0.) & (u <= 1.)
+  # Moves along the line only count if they touch it at a single point.
+  collinear = (denominator == 0.) & (numerator_t == 0.)
+  if np.any(collinear):
+    length = vx * vx + vy * vy
+    ta = (wx * vx + wy * vy) / length
+    tb = ((bx - x1) * vx + (by - y1) * vy) / length
+    lower = np.maximum(np.minimum(ta, tb), 0.)
+    upper = np.minimum(np.maximum(ta, tb), 1.)
+    crossing = crossing | (collinear & (lower == upper))
+    t = np.where(collinear, lower, t)
+  t = np.where(crossing, t, 0.)
+  # Distances from both ends of the move to the intersection.
+  ix, iy = x1 + t * vx, y1 + t * vy
+  d1 = np.hypot(ix - x1, iy - y1)
+  d2 = np.hypot(ix - x2, iy - y2)
+  forward = vx * direction[0] + vy * direction[1] > 0.
+  # Don't count if only the starting point (when going forward) or the end point (when going
+  # backward) crosses. This hysteresis is needed to avoid double counting.
+  forward_crossing = crossing & forward & (d1 >= 0.5)
+  backward_crossing = crossing & ~forward & (d2 >= 0.5)
+  dlap = np.where(forward_crossing, 1, np.where(backward_crossing, -1, 0))
+  dround = np.where(forward_crossing, d1 / np.hypot(vx, vy), 0.)
+  return dlap, dround
+
+
+def _SupercoverOffsets(dx, dy):
+  # Returns the lower-left corners, relative to the start point, of all unit cells whose closed
+  # square touches the segment [(0, 0), (dx, dy)]. The displacement is integer, which keeps all
+  # the arithmetic exact. Results are memoized since there are few distinct displacements.
+  key = (dx, dy)
+  if key in _supercover_offsets:
+    return _supercover_offsets[key]
+  cx, cy = np.meshgrid(np.arange(min(dx, 0) - 1, max(dx, 0) + 1), np.arange(min(dy, 0) - 1, max(dy, 0) + 1), indexing='ij')
+  cx = cx.ravel()
+  cy = cy.ravel()
+  # A cell is touched if its four corners are not strictly on the same side of the line.
+  corners = np.array([dx * (cy + oy) - dy * (cx + ox) for ox, oy in ((0, 0), (0, 1), (1, 0), (1, 1))])
+  touched = (np.min(corners, axis=0) <= 0) & (np.max(corners, axis=0) >= 0)
+  offsets = tuple(zip(cx[touched].tolist(), cy[touched].tolist()))
+  _supercover_offsets[key] = offsets
+  return offsets
+
+
+_supercover_offsets = {}
+
+
+def _SegmentCrossesEdges(xy1, xy2, edges):
+  # Returns whether the segment properly crosses any of the edges and whether it touches any of
+  # them in a degenerate way (collinear or through an endpoint).
+  def Orientation(ax, ay, bx, by, px, py):
+    area = (bx - ax) * (py - ay) - (by - ay) * (px - ax)
+    return 1 if area > _RASTER_EPSILON else -1 if area < -_RASTER_EPSILON else 0
+
+  x1, y1, x2, y2 = float(xy1[0]), float(xy1[1]), float(xy2[0]), float(xy2[1])
+  touching = False
+  for ax, ay, bx, by in edges:
+    o1 = Orientation(x1, y1, x2, y2, ax, ay)
+    o2 = Orientation(x1, y1, x2, y2, bx, by)
+    o3 = Orientation(ax, ay, bx, by, x1, y1)
+    o4 = Orientation(ax, ay, bx, by, x2, y2)
+    if o1 * o2 < 0 and o3 * o4 < 0:
+      return True, touching
+    if o1 * o2 > 0 or o3 * o4 > 0:
+      continue
+    if o1 == 0 and o2 == 0:
+      # Collinear edges only touch if their extents overlap.
+      if (max(ax, bx) < min(x1, x2) - _RASTER_EPSILON or min(ax, bx) > max(x1, x2) + _RASTER_EPSILON or
+          max(ay, by) < min(y1, y2) - _RASTER_EPSILON or min(ay, by) > max(y1, y2) + _RASTER_EPSILON):
+        continue
+    touching = True
+  return False, touching
+
+
 def _BuildPolygonWithHole(outer, inner, origin=np.array((0, 0)), resize=1.):
   outer = np.array([(outer[i], outer[i + 1]) for i in xrange(0, len(outer), 2)]) - origin
   inner = np.array([(inner[i], inner[i + 1]) for i in xrange(0, len(inner), 2)]) - origin
@@ -323,19 +1004,34 @@ def _BuildPolygonWithHole(outer, inner, origin=np.array((0, 0)), resize=1.):
   return geometry.Polygon(outer, [inner])
 
 
+def _ReadCircuitName(filename):
+  with open(filename) as fp:
+    for l in fp:
+      if l.startswith('name = '):
+        return l.strip().split(' = ', 1)[1]
+  return None
+
+
+def _ParseCircuitFile(filename):
+  with open(filename) as fp:
+    configuration = dict(l.strip().split(' = ', 1) for l in fp.readlines() if ' = ' in l)
+  # Keep backward compatibility.
+  return {
+      'circuit_name': configuration['name'],
+      'circuit_grid_size': configuration['gridSize'] if 'gridSize' in configuration else 10,
+      'circuit_maximum_speed': configuration['maximumSpeed'],
+      'num_laps': int(configuration['numLaps']) if 'numLaps' in configuration else 1,
+      'circuit_starting_line': [int(n) for n in configuration['startingLine'].split(',')],
+      'circuit_inner_border': [int(n) for n in configuration['innerBorder'].split(',')],
+      'circuit_outer_border': [int(n) for n in configuration['outerBorder'].split(',')],
+  }
+
+
 def _BuildLineString(points, origin=np.array((0, 0)), resize=1.):
   points = (np.array([(points[i], points[i + 1]) for i in xrange(0, len(points), 2)]) - origin) * resize
   return geometry.LineString(points)
 
 
-def _NormalizeAngle(angle):
-    while angle > math.pi:
-      angle -= 2. * math.pi
-    while angle < -math.pi:
-      angle += 2. * math.pi
-    return angle
-
-
 _DEFAULT_CIRCUIT_NAME = 'Patatoid'
 
 # Format is kept almost identical to the original CirKuit 2D game.
@@ -1,69 +1,455 @@
+from __future__ import print_function
+
 import collections
-import matplotlib.pyplot as plt
-from matplotlib.patches import Polygon
+import cPickle as pickle
+import multiprocessing
 import numpy as np
-from scipy import spatial
-from scipy import interpolate
+import os
 from shapely import geometry
-from shapely import prepared
+import tempfile
+import threading
 
 import circuit
+import compiled_circuit
+import transition_graph
+import triangulation
 import util
 
 _OFFSET_FACTOR = 0.1  # Must be strictly smaller than 1/3.
 _EXTRA_LENGTH = _OFFSET_FACTOR * 3.  # Compensation for slightly offsetting the finish point.
 _EPSILON = 1e-5
+_ON_EDGE_TOLERANCE = 1e-9  # Barycentric coordinate below which grid points are on a triangle edge.
+_GEODESIC_CHUNK_SIZE = 1024  # Points processed at once by _GeodesicDistances().
+_POOL_CHUNK_SIZE = 256  # Smaller chunks balance the load across processes.
+_POOL_MIN_POINTS = 4096  # Fewer points are solved faster without the pool.
+_WEDGE_PROBE = 1e-6  # Distance from a vertex used to find the wedge a segment leaves through.
+
+# Must be incremented whenever the compiled circuits (see Compile()) change.
+ANALYZER_VERSION = 6
 
 analyzer_instances = {}
 analyzer_instances_lock = util.RWLock()
+analyzer_builds = {}  # Analyzers being built.
+analyzer_builds_lock = threading.Lock()
+warmup_thread = None
+transition_graphs = {}
+transition_graphs_lock = threading.Lock()
+_pooled_data = None  # Filename and data of the last geodesic computation (in pool workers).
+
+
+class Error(Exception):
+  pass
+
+
+class AnalyzerBuildingError(Error):
+  pass
+
+
+class AnalyzerBuildFailedError(Error):
+  pass
+
+
+class _AnalyzerBuild(object):
+  """Single build of an analyzer shared by all the callers requesting it.
+
+  A failed build is kept (until the server restarts) so that later callers get its error instead
+  of starting the same build again.
+  """
 
+  def __init__(self):
+    self.done = threading.Event()
+    self.analyzer = None
+    self.error = None
 
-def GetAnalyzer(name=None, plot=False):
+  def Run(self, name, plot, processes):
+    try:
+      self.analyzer = _LoadAnalyzer(name, plot, processes)
+      _AddAnalyzer(name, self.analyzer)
+      with analyzer_builds_lock:
+        del analyzer_builds[name]
+    except circuit.CircuitDoesNotExistError as e:
+      self.error = e
+    except Exception as e:
+      print('Unable to analyze %s: %s' % (name, e))
+      self.error = AnalyzerBuildFailedError('%s could not be analyzed: %s' % (name, e))
+    finally:
+      self.done.set()
+
+  def Result(self):
+    self.done.wait()
+    if self.error is not None:
+      raise self.error
+    return self.analyzer
+
+
+def GetAnalyzer(name=None, plot=False, processes=1, block=True):
+    # The distance map of a circuit that is not compiled yet is computed by the given number of
+    # processes (all CPUs if None). Concurrent calls for the same circuit share the same build,
+    # while other circuits are not affected. If block is False, the build happens in the
+    # background and AnalyzerBuildingError is raised until it is done. The error of a failed build
+    # is raised by all later calls.
     if name is None:
       name = circuit._DEFAULT_CIRCUIT_NAME
     with analyzer_instances_lock(util.READ_LOCKED):
       if name in analyzer_instances:
-        analyzer = analyzer_instances[name]
+        return analyzer_instances[name]
+    with analyzer_builds_lock:
+      # The build may have finished in the meantime.
+      with analyzer_instances_lock(util.READ_LOCKED):
+        if name in analyzer_instances:
+          return analyzer_instances[name]
+      build = analyzer_builds.get(name)
+      new_build = build is None
+      if new_build:
+        build = analyzer_builds[name] = _AnalyzerBuild()
+    if not block and not build.done.is_set():
+      if new_build:
+        if name not in circuit.Circuit.CircuitNames():
+          with analyzer_builds_lock:
+            del analyzer_builds[name]
+          raise circuit.CircuitDoesNotExistError('%s does not exist.' % name)
+        thread = threading.Thread(target=build.Run, args=(name, plot, processes))
+        thread.daemon = True
+        thread.start()
+      raise AnalyzerBuildingError('%s is being analyzed.' % name)
+    if new_build:
+      build.Run(name, plot, processes)
+    return build.Result()
+
+
+def Warmup(processes=None):
+  # Builds the analyzers of all circuits. Compiled circuits are loaded right away and the others
+  # are analyzed in the background, in parallel by a pool of processes.
+  global warmup_thread
+  pending = []
+  for name in sorted(circuit.Circuit.CircuitNames()):
+    compiled = compiled_circuit.Load(name, ANALYZER_VERSION)
+    if compiled is None:
+      pending.append(name)
+    else:
+      _AddAnalyzer(name, CircuitAnalyzer.FromCompiled(circuit.Circuit(name, compiled=compiled), compiled))
+  # The pool is created right away, before other threads are started, and only if needed.
+  pool = multiprocessing.Pool(processes=processes) if pending else None
+  warmup_thread = threading.Thread(target=_Warmup, args=(pending, pool, processes or multiprocessing.cpu_count()))
+  warmup_thread.daemon = True
+  warmup_thread.start()
+
+
+def WarmupStarted():
+  return warmup_thread is not None
+
+
+def GetTransitionGraph(name=None):
+  # Returns the transition graph of a circuit if it was compiled (see CompileTransitionGraph()),
+  # and None otherwise.
+  if name is None:
+    name = circuit._DEFAULT_CIRCUIT_NAME
+  with transition_graphs_lock:
+    if name not in transition_graphs:
+      arrays = compiled_circuit.Load(name, ANALYZER_VERSION, kind='graph')
+      transition_graphs[name] = None if arrays is None else transition_graph.TransitionGraph.FromArrays(arrays)
+    return transition_graphs[name]
+
+
+def CompileTransitionGraph(name=None, min_lap=-1):
+  # Enumerates all reachable states of a circuit. This takes a few seconds and a few hundred MB,
+  # so it is meant to be done offline (see analyze_circuit.py).
+  if name is None:
+    name = circuit._DEFAULT_CIRCUIT_NAME
+  graph = transition_graph.Build(GetAnalyzableCircuit(name), min_lap=min_lap)
+  compiled_circuit.Save(name, ANALYZER_VERSION, graph.Arrays(), kind='graph')
+  with transition_graphs_lock:
+    transition_graphs[name] = graph
+  return graph
+
+
+def ReadyCircuitNames():
+  # Circuits that can be played without waiting. Until Warmup() is called, analyzers are built on
+  # demand and all circuits are listed.
+  names = circuit.Circuit.CircuitNames()
+  if not WarmupStarted():
+    return names
+  with analyzer_instances_lock(util.READ_LOCKED):
+    return [name for name in names if name in analyzer_instances]
+
+
+def _Warmup(pending, pool, processes):
+  if pool is not None:
+    try:
+      if len(pending) >= processes:
+        # One circuit per process.
+        for name, compiled in pool.imap_unordered(_CompileWorker, pending):
+          if compiled is None:
+            continue
+          compiled_circuit.Save(name, ANALYZER_VERSION, compiled)
+          _AddAnalyzer(name, CircuitAnalyzer.FromCompiled(circuit.Circuit(name, compiled=compiled), compiled))
       else:
-        analyzer_instances_lock.promote()  # Write locked.
-        analyzer = CircuitAnalyzer(circuit.Circuit(name), plot=plot)
-        analyzer_instances[name] = analyzer
-    return analyzer
+        # Too few circuits to keep all processes busy: the distance map of each circuit is split
+        # across the pool instead (pool workers cannot create processes themselves).
+        for name in pending:
+          try:
+            analyzer = CircuitAnalyzer(circuit.Circuit(name), pool=pool)
+          except Exception as e:
+            print('Unable to analyze %s: %s' % (name, e))
+            continue
+          compiled_circuit.Save(name, ANALYZER_VERSION, _Compile(analyzer))
+          _AddAnalyzer(name, analyzer)
+    finally:
+      pool.close()
+      pool.join()
+  print('Warmup done:', len(ReadyCircuitNames()), 'circuits ready.')
+
+
+def _CompileWorker(name):
+  try:
+    return name, _Compile(CircuitAnalyzer(circuit.Circuit(name)))
+  except Exception as e:  # The other circuits are still usable.
+    print('Unable to analyze %s: %s' % (name, e))
+    return name, None
 
 
-def GetAnalyzableCircuit(name=None):
+def _AddAnalyzer(name, analyzer):
+  with analyzer_instances_lock(util.WRITE_LOCKED):
+    analyzer_instances.setdefault(name, analyzer)
+
+
+def _LoadAnalyzer(name, plot, processes):
+  # Plotting needs the intermediate results of the construction.
+  compiled = None if plot else compiled_circuit.Load(name, ANALYZER_VERSION)
+  if compiled is not None:
+    return CircuitAnalyzer.FromCompiled(circuit.Circuit(name, compiled=compiled), compiled)
+  if processes == 1:
+    analyzer = CircuitAnalyzer(circuit.Circuit(name), plot=plot)
+  else:
+    pool = multiprocessing.Pool(processes=processes)
+    try:
+      analyzer = CircuitAnalyzer(circuit.Circuit(name), plot=plot, pool=pool)
+    finally:
+      pool.close()
+      pool.join()
+  compiled_circuit.Save(name, ANALYZER_VERSION, _Compile(analyzer))
+  return analyzer
+
+
+def _Compile(analyzer):
+  compiled = analyzer.circuit.Compile()
+  compiled.update(analyzer.Compile())
+  return compiled
+
+
+def GetCacheStats():
+  # Cache statistics of all circuits loaded so far.
+  with analyzer_instances_lock(util.READ_LOCKED):
+    return dict((name, analyzer.circuit.CacheStats()) for name, analyzer in analyzer_instances.items())
+
+
+def GetAnalyzableCircuit(name=None, block=True):
   print('Loading circuit:', name)
-  circuit_analyzer = GetAnalyzer(name)
+  circuit_analyzer = GetAnalyzer(name, block=block)
   circuit_analyzer.circuit.SetAnalyzer(circuit_analyzer)
   return circuit_analyzer.circuit
 
 
 class CircuitAnalyzer(object):
 
-  def __init__(self, circuit, plot=False):
-    # Construct mapping from each valid circuit point to the distance to the finish.
+  def __init__(self, circuit, plot=False, pool=None):
+    # Construct mapping from each valid circuit point to the distance to the finish. The points
+    # are split in chunks solved by the given pool of processes (if any).
     self.circuit = circuit
-    self._BuildDistanceMap(plot=plot)
+    self._BuildDistanceMap(plot=plot, pool=pool)
+    self.point_indices = _PointIndices(self.distance_field)
+    running, targets, dlap, dround = self._MoveOutcomes()
+    self._BuildRoundsToGo(running, targets, dlap, dround)
+    self._BuildViability(running, targets, dlap)
+
+  @staticmethod
+  def FromDistanceField(circuit, distance_field, origin, max_distance, rounds_to_go, viable):
+    # Builds an analyzer from precomputed tables (see FromCompiled()).
+    analyzer = CircuitAnalyzer.__new__(CircuitAnalyzer)
+    analyzer.circuit = circuit
+    analyzer.distance_field = distance_field
+    analyzer.origin = origin
+    analyzer.max_distance = max_distance
+    analyzer.point_indices = _PointIndices(distance_field)
+    analyzer.rounds_to_go = rounds_to_go
+    analyzer.viable = viable
+    return analyzer
+
+  @staticmethod
+  def FromCompiled(circuit, compiled):
+    return CircuitAnalyzer.FromDistanceField(
+        circuit, compiled['distance_field'], tuple(compiled['distance_origin'].tolist()), float(compiled['max_distance']),
+        compiled['rounds_to_go'], compiled['viable'])
+
+  def Compile(self):
+    # Arrays passed back to FromCompiled().
+    return {
+        'distance_field': self.distance_field,
+        'distance_origin': np.array(self.origin, dtype=int),
+        'max_distance': np.array(self.max_distance, dtype=float),
+        'rounds_to_go': self.rounds_to_go,
+        'viable': self.viable,
+    }
 
   def Distance(self, point):
-    return self.distances[tuple(point)]
+    d = self._Lookup(point)
+    if d != d:
+      raise KeyError(tuple(point))
+    return d
+
+  def Distances(self, x, y):
+    # Vectorized version of Distance() for arrays of coordinates. Points outside the road get NaN.
+    i = np.asarray(x, dtype=int) - self.origin[0]
+    j = np.asarray(y, dtype=int) - self.origin[1]
+    num_x, num_y = self.distance_field.shape
+    inside = (i >= 0) & (j >= 0) & (i < num_x) & (j < num_y)
+    return np.where(inside, self.distance_field[np.where(inside, i, 0), np.where(inside, j, 0)], np.nan).astype(float)
 
   def Contains(self, point):
-    return tuple(point) in self.distances
+    d = self._Lookup(point)
+    return d == d
+
+  def ContainsPoints(self, x, y):
+    # Vectorized version of Contains().
+    return ~np.isnan(self.Distances(x, y))
+
+  def Points(self):
+    # Returns all points on the road as an array of shape (N, 2).
+    return np.argwhere(~np.isnan(self.distance_field)) + self.origin
+
+  def RoundsToGo(self, x, y, moves, laps_left):
+    # Lower bound on the number of rounds needed to cross the finish line laps_left times from
+    # the grid points (x, y) when the last move was moves (indices into Circuit.moves, or
+    # len(Circuit.moves) when stopped). All arguments are arrays. Unknown states get 0.
+    points = self._PointIndices(x, y)
+    num_levels, _, num_columns = self.rounds_to_go.shape
+    known = (points >= 0) & (moves >= 0) & (moves < num_columns) & (laps_left > 0)
+    levels = np.clip(laps_left - 1, 0, num_levels - 1)
+    return np.where(known, self.rounds_to_go[levels, np.maximum(points, 0), np.where(known, moves, 0)], 0.).astype(float)
+
+  def Viable(self, x, y, moves):
+    # Whether running cars at the grid points (x, y) whose last move was moves (see RoundsToGo())
+    # may avoid crashing. Only returns False for states that crash whatever the next moves.
+    points = self._PointIndices(x, y)
+    known = (points >= 0) & (moves >= 0) & (moves < self.viable.shape[1])
+    return np.where(known, self.viable[np.maximum(points, 0), np.where(known, moves, 0)], True)
+
+  def _PointIndices(self, x, y):
+    # Indices of the grid points (x, y) in Points() (-1 outside the road).
+    i = np.asarray(x, dtype=int) - self.origin[0]
+    j = np.asarray(y, dtype=int) - self.origin[1]
+    num_x, num_y = self.point_indices.shape
+    inside = (i >= 0) & (j >= 0) & (i < num_x) & (j < num_y)
+    return np.where(inside, self.point_indices[np.where(inside, i, 0), np.where(inside, j, 0)], -1)
+
+  def _Lookup(self, point):
+    i = int(point[0]) - self.origin[0]
+    j = int(point[1]) - self.origin[1]
+    num_x, num_y = self.distance_field.shape
+    if i < 0 or j < 0 or i >= num_x or j >= num_y:
+      return np.nan
+    return self.distance_field.item(i, j)
 
   def MaxDistance(self):
     return self.max_distance
 
-  def _BuildDistanceMap(self, plot=False):
+  def _MoveOutcomes(self):
+    # Outcome of every move (see Circuit.moves) from every point (see Points()), ignoring other
+    # players. Returns whether the moves keep running, the points they lead to and their dlap and
+    # dround (see CrossingLines()), all of shape (len(points), len(moves)).
+    circuit = self.circuit
+    points = self.Points()
+    num_moves = len(circuit.moves)
+    x1 = np.repeat(points[:, :1], num_moves, axis=1)
+    y1 = np.repeat(points[:, 1:], num_moves, axis=1)
+    x2 = x1 + circuit.moves_array[:, 0]
+    y2 = y1 + circuit.moves_array[:, 1]
+    running = self.ContainsPoints(x2, y2) & circuit.MovesMayBeOnRoad(points[:, 0], points[:, 1])
+    # The raster rules out most crashes, the remaining moves are tested exactly.
+    candidates = np.nonzero(running)
+    running[candidates] = circuit.SegmentsOnRoad(x1[candidates], y1[candidates], x2[candidates], y2[candidates])
+    dlap, dround = circuit.CrossingLines(x1, y1, x2, y2)
+    targets = np.where(running, self._PointIndices(x2, y2), 0)
+    return running, targets, dlap, dround
+
+  def _BuildViability(self, running, targets, dlap):
+    # Backward fixpoint over the move outcomes (see _MoveOutcomes()). viable[p, k] is False when a
+    # car at point p (see Points()) after move k crashes whatever it does next. Moves crossing the
+    # finish line forward may end the race and are always considered safe.
+    circuit = self.circuit
+    num_moves = len(circuit.moves)
+    columns = np.arange(num_moves)
+    viable = np.ones(running.shape, dtype=bool)
+    while True:
+      safe = running & ((dlap > 0) | viable[targets, columns])
+      next_viable = np.logical_or.reduceat(safe.T[circuit.template_moves], circuit.template_offsets[:-1]).T
+      if np.array_equal(next_viable, viable):
+        break
+      viable = next_viable
+    # The last column holds stopped cars.
+    self.viable = np.hstack((viable, safe[:, _StoppedMoves(circuit.move_indices)].any(axis=1)[:, None]))
+
+  def _BuildRoundsToGo(self, running, targets, dlap, dround):
+    # Backward relaxation over the move outcomes (see _MoveOutcomes()). rounds_to_go[n, p, k] is
+    # a lower bound on the number of rounds needed to cross the finish line n + 1 times from
+    # point p (see Points()) after move k. The last move costs a fraction of a round (see
+    # CrossingLines()). Other players are ignored and more than Laps() + 1 crossings (i.e.,
+    # after driving backwards over the line) cost as much as Laps() + 1 crossings.
+    circuit = self.circuit
+    num_points, num_moves = running.shape
+    num_levels = circuit.Laps() + 1
+    # Rows are (level, point) pairs, where the level is the number of crossings left minus one.
+    levels = np.arange(num_levels)[:, None, None] - dlap
+    terminal = (running & (levels < 0)).reshape(-1, num_moves)
+    step = (running & (levels >= 0)).reshape(-1, num_moves)
+    next_rows = (np.minimum(levels, num_levels - 1) * num_points + targets).reshape(-1, num_moves)
+    dround = np.tile(dround, (num_levels, 1))
+    # Costs are pushed to the rounds of the moves whose template hold them, and rounds to the costs
+    # of the moves leading to them. Only values that decreased are pushed further.
+    columns = np.arange(num_moves)
+    owners = np.repeat(columns, np.diff(circuit.template_offsets))
+    order = np.argsort(circuit.template_moves, kind='mergesort')
+    owners = owners[order]
+    owner_offsets = np.searchsorted(circuit.template_moves[order], np.arange(num_moves + 1))
+    dependencies = (next_rows * num_moves + columns)[step]  # Flat indices into rounds.
+    dependents = np.flatnonzero(step)  # Flat indices into costs.
+    order = np.argsort(dependencies, kind='mergesort')
+    dependencies, dependents = dependencies[order], dependents[order]
+    rounds = np.full((num_levels * num_points, num_moves), np.inf)
+    costs = np.where(terminal, dround, np.inf)
+    changed = np.flatnonzero(terminal)  # Flat indices into costs.
+    while len(changed):
+      rows, moves = np.divmod(changed, num_moves)
+      begin = owner_offsets[moves]
+      entries = _Ranges(begin, owner_offsets[moves + 1] - begin)
+      updated = np.repeat(rows, np.diff(owner_offsets)[moves]) * num_moves + owners[entries]
+      values = np.repeat(costs.flat[changed], np.diff(owner_offsets)[moves])
+      updated, values = _Minimum(updated, values)
+      improved = values < rounds.flat[updated]
+      updated, values = updated[improved], values[improved]
+      rounds.flat[updated] = values
+      begin = np.searchsorted(dependencies, updated, side='left')
+      entries = _Ranges(begin, np.searchsorted(dependencies, updated, side='right') - begin)
+      updated, values = _Minimum(dependents[entries], 1. + rounds.flat[dependencies[entries]])
+      improved = values < costs.flat[updated]
+      changed = updated[improved]
+      costs.flat[changed] = values[improved]
+    # The last column holds stopped cars.
+    rounds = np.hstack((rounds, costs[:, _StoppedMoves(circuit.move_indices)].min(axis=1)[:, None])).reshape(num_levels, num_points, num_moves + 1)
+    # Stored in single precision, rounded down.
+    self.rounds_to_go = rounds.astype(np.float32)
+    rounded_up = self.rounds_to_go > rounds
+    self.rounds_to_go[rounded_up] = np.nextafter(self.rounds_to_go[rounded_up], np.float32(0))
+
+  def _BuildDistanceMap(self, plot=False, pool=None):
     # First, build the polygon that is cut by the starting line.
     start_direction = self.circuit.GetStartingDirection().astype(float)
     cut_interior = _CutLineRing(self.circuit.raw_drivable_road.interiors[0], self.circuit.starting_line, start_direction)
     cut_exterior = _CutLineRing(self.circuit.raw_drivable_road.exterior, self.circuit.starting_line, start_direction)
     polygon = geometry.Polygon(list(cut_interior.coords) + list(reversed(list(cut_exterior.coords))))
     if not polygon.exterior.is_simple and plot:
-      plt.plot(polygon.exterior.xy[0], polygon.exterior.xy[1], 'k', linewidth=2)
-      plt.axis('equal')
-      plt.show()
+      import circuit_plot
+      circuit_plot.PlotPolygon(polygon)
     assert polygon.exterior.is_simple, 'Ooops.'
 
     # Place starting and finishing points.
@@ -76,40 +462,22 @@ class CircuitAnalyzer(object):
       points[i, 0] = polygon.exterior.coords[i][0]
       points[i, 1] = polygon.exterior.coords[i][1]
 
-    # Make triangulation.
-    # TODO: Find the option of qhull that will keep only the triangles inside the polygon.
-    #       Also at the moment it can delete the point at the boundary (which is not ideal).
-    triangles = spatial.Delaunay(points)
-    # Mark triangles that are outside the polygon as invalid.
-    polygon = prepared.prep(polygon)
-    polys = []
-    polys_center = []  # The inside polygon check is faster and more robust if we take the center.
-    finish_triangle_index = None
-    for i, triangle in enumerate(triangles.simplices):
-      polys.append(geometry.Polygon(points[triangle]))
-      polys_center.append(geometry.Point(np.mean(points[triangle], axis=0)))
-      if finish_triangle_index is None and polys[-1].contains(geometry.Point(finish_point)):
-        finish_triangle_index = i
-    valid = np.array(list(map(polygon.contains, polys_center))).astype(bool)
-    assert finish_triangle_index is not None, 'Ooops'
+    # Make triangulation. All triangles are inside the polygon and all its vertices are kept
+    # (repeated vertices are dropped).
+    triangles = triangulation.TriangulatePolygon(points)
+    points = triangles.points
+    finish_triangle_index = int(triangles.find_simplex(finish_point[None])[0])
+    assert finish_triangle_index >= 0, 'Ooops'
     # Map each point on the grid to a triangle.
     bounds = tuple(int(b) for b in self.circuit.drivable_road_bounds)
-    point_to_triangle = {}
-    for x in range(bounds[0], bounds[2] + 1):
-      for y in range(bounds[1], bounds[3] + 1):
-        p = (x, y)
-        for i, t in enumerate(polys):
-          if valid[i] and t.contains(geometry.Point(p)):
-            point_to_triangle[p] = i
+    point_to_triangle = _LocatePoints(triangles, bounds, self.circuit.Contains)
 
     # We build the adjacency list (it also holds the edge information).
     # This adjacency list must be a tree (since we do not have holes inside the road).
     adjacency_lists = {}
     for i in range(len(triangles.simplices)):
-      if not valid[i]:
-        continue
       adjacency_lists[i] = []
-      for n in (n for n in triangles.neighbors[i] if n >= 0 and valid[n]):
+      for n in (n for n in triangles.neighbors[i] if n >= 0):
         # Purposefully store edge backwards.
         adjacency_lists[i].append(_BuildEdge(n, i, triangles.simplices, points))
     # Find the path from any node to the finish (BFS or DFS would do - use DFS).
@@ -130,63 +498,239 @@ class CircuitAnalyzer(object):
         stack.append(edge.start.id)
 
     # Find the shortest path from each valid point to the finish.
-    try:
-      self.distances = {}
-      self.max_distance = 0
-      for point, start_triangle_index in point_to_triangle.items():
-        self.distances[point] = _FindDistance(np.array(point), start_triangle_index, finish_point, triangle_tree) + _EXTRA_LENGTH
-        self.max_distance = max(self.max_distance, self.distances[point])
-    except KeyError as e:
+    distances = {}
+    self.max_distance = 0
+    reachable = [p for p, i in sorted(point_to_triangle.items()) if i in triangle_tree]
+    if len(reachable) < len(point_to_triangle):
       if plot:
         print('Error while processing circuit, but trying to continue anyways...')
       else:
-        raise e
+        raise KeyError('Some triangles are not connected to the finish.')
+    if reachable:
+      geodesic_distances = _GeodesicDistances(np.array(reachable, dtype=float), triangles, finish_point, triangle_tree, pool)
+      for point, d in zip(reachable, geodesic_distances.tolist()):
+        if np.isinf(d):
+          # Only happens if the visibility tests are inconclusive.
+          d = _FindDistance(np.array(point), point_to_triangle[point], finish_point, triangle_tree)
+        distances[point] = d + _EXTRA_LENGTH
+        self.max_distance = max(self.max_distance, distances[point])
+    # Dense distance field over the bounds (NaN outside the road).
+    self.origin = bounds[:2]
+    self.distance_field = np.full((bounds[2] - bounds[0] + 1, bounds[3] - bounds[1] + 1), np.nan, dtype=np.float32)
+    for (x, y), d in distances.items():
+      self.distance_field[x - bounds[0], y - bounds[1]] = d
 
     if plot:
-      # Plot distance.
-      if self.distances:
-        x = []
-        y = []
-        z = []
-        for k, v in self.distances.items():
-          x.append(k[0])
-          y.append(k[1])
-          z.append(v)
-        datapoints = np.array((x, y)).T
-        z = np.array(z)
-        XI, YI = np.meshgrid(range(bounds[0], bounds[2] + 1), range(bounds[1], bounds[3] + 1))
-        ZI = interpolate.griddata(datapoints, z, (XI, YI), method='nearest')
-        cmap = plt.get_cmap('RdYlGn_r')
-        im = plt.imshow(ZI, cmap=cmap, interpolation='nearest', origin='lower',
-                        extent=[bounds[0] - 0.5, bounds[2] + 0.5, bounds[1] - 0.5, bounds[3] + 0.5])
-        # Mask outside road.
-        plt.gca().add_patch(Polygon(self.circuit.raw_drivable_road.interiors[0].coords, facecolor='white', edgecolor='none'))
-        patch = Polygon(self.circuit.raw_drivable_road.exterior.coords, facecolor='none')
-        plt.gca().add_patch(patch)
-        im.set_clip_path(patch)
-
-      # Plot triangles.
-      plt.plot(points[:, 0], points[:, 1], 'k--', linewidth=2)
-      plt.plot(finish_point[0], finish_point[1], 'ro')
-      plt.triplot(points[:, 0], points[:, 1], triangles.simplices[valid].copy())
-      for edge in triangle_tree.itervalues():
-        if edge is None:
-          continue
-        plt.plot([edge.start.xy[0], edge.end.xy[0]], [edge.start.xy[1], edge.end.xy[1]], 'c--')
-        plt.plot([edge.gate.left.xy[0]], [edge.gate.left.xy[1]], 'r+')
-        plt.plot([edge.gate.right.xy[0]], [edge.gate.right.xy[1]], 'b+')
-      # Plot grid.
-      valid_points = []
-      for x in range(bounds[0], bounds[2] + 1):
-        for y in range(bounds[1], bounds[3] + 1):
-          p = (x, y)
-          if p in self.distances:
-            valid_points.append(p)
-      if valid_points:
-        valid_points = np.array(valid_points).astype(float)
-        plt.scatter(valid_points[:, 0], valid_points[:, 1], c='gray', marker='+')
-      plt.axis('equal')
-      plt.show()
+      import circuit_plot  # Only loaded when plotting (matplotlib is slow to import).
+      circuit_plot.PlotDistanceMap(self.circuit, distances, bounds, points, finish_point, triangles, triangle_tree)
+
+
+def _StoppedMoves(move_indices):
+  # Indices of the moves of stopped cars (see Circuit.move_indices).
+  return [move_indices[tuple(d)] for d in circuit._DIRECTIONS_WHEN_STOPPED]
+
+
+def _Ranges(begin, counts):
+  # Concatenation of the ranges [begin[i], begin[i] + counts[i]).
+  return np.repeat(begin - np.cumsum(counts) + counts, counts) + np.arange(np.sum(counts))
+
+
+def _Minimum(indices, values):
+  # Returns the unique indices and the smallest value of each.
+  order = np.lexsort((values, indices))
+  indices, values = indices[order], values[order]
+  first = np.ones(len(indices), dtype=bool)
+  first[1:] = indices[1:] != indices[:-1]
+  return indices[first], values[first]
+
+
+def _PointIndices(distance_field):
+  # Index of each point of the distance field in Points() (-1 outside the road).
+  indices = np.full(distance_field.shape, -1, dtype=np.int32)
+  on_road = ~np.isnan(distance_field)
+  indices[on_road] = np.arange(np.count_nonzero(on_road))
+  return indices
+
+
+def _LocatePoints(triangles, bounds, contains):
+  # Returns a dict mapping the grid points within bounds to the triangle that contains them.
+  # Points on the boundary of the polygon are dropped, unless contains() says otherwise: it
+  # decides the points that are within rounding errors of the boundary.
+  x, y = np.meshgrid(np.arange(bounds[0], bounds[2] + 1), np.arange(bounds[1], bounds[3] + 1), indexing='ij')
+  points = np.column_stack((x.ravel(), y.ravel()))
+  simplices = triangles.find_simplex(points.astype(float))
+  located = simplices >= 0
+  points = points[located]
+  simplices = simplices[located]
+  # Barycentric coordinates tell which edges the points are on. Points on an edge between two
+  # triangles are inside the polygon, but vertices are all on its boundary.
+  transform = triangles.transform[simplices]
+  b = np.einsum('ijk,ik->ij', transform[:, :2], points - transform[:, 2])
+  b = np.column_stack((b, 1. - b.sum(axis=1)))
+  on_edge = b <= _ON_EDGE_TOLERANCE
+  on_boundary = (on_edge & (triangles.neighbors[simplices] < 0)).any(axis=1) | (on_edge.sum(axis=1) > 1)
+  on_boundary[on_boundary] = [not contains(p) for p in points[on_boundary].tolist()]
+  return dict(zip(map(tuple, points[~on_boundary].tolist()), simplices[~on_boundary].tolist()))
+
+
+###########################################
+# Shortest paths through polygon vertices #
+###########################################
+
+def _GeodesicDistances(points, triangles, finish_point, triangle_tree, pool=None):
+  # Returns the length of the shortest path from each point to the finish through the corridor
+  # of triangles given by triangle_tree (the same paths as _FindDistance()). Shortest paths only
+  # bend at reflex corners of the corridor: the geodesic distance of these corners is computed
+  # once, and each point then picks the best visible corner. The points are independent and are
+  # split in chunks (solved by the pool if given and if there are enough points) whose results are
+  # concatenated in order.
+  simplices = triangles.simplices
+  vertices = triangles.points
+  links = set()
+  for edge in triangle_tree.values():
+    if edge is not None:
+      links.add((edge.start.id, edge.end.id))
+      links.add((edge.end.id, edge.start.id))
+  # The corners of a vertex are split in wedges by walls, which are all triangle edges not
+  # crossed by the corridor. Walls are stored with the triangle they belong to.
+  wedges = -np.ones(simplices.shape, dtype=int)
+  for i in range(len(simplices)):
+    wedges[i] = 3 * i + np.arange(3)
+  walls = []
+  for i in range(len(simplices)):
+    for k in range(3):
+      a, b = simplices[i, (k + 1) % 3], simplices[i, (k + 2) % 3]
+      n = triangles.neighbors[i, k]
+      if (i, n) not in links:
+        walls.append((a, b, i))
+      elif i < n:
+        for v in (a, b):
+          _MergeWedges(wedges, wedges[i, simplices[i] == v][0], wedges[n, simplices[n] == v][0])
+  walls = np.array(walls, dtype=int).reshape(-1, 3)
+  # Reflex corners are wedges with an angle larger than pi. Flat corners are kept since segments
+  # going through them are considered blocked.
+  angles = np.zeros(simplices.shape)
+  for k in range(3):
+    u = vertices[simplices[:, (k + 1) % 3]] - vertices[simplices[:, k]]
+    v = vertices[simplices[:, (k + 2) % 3]] - vertices[simplices[:, k]]
+    angles[:, k] = np.abs(np.arctan2(u[:, 0] * v[:, 1] - u[:, 1] * v[:, 0], (u * v).sum(axis=1)))
+  wedge_angles = np.bincount(wedges.ravel(), weights=angles.ravel())
+  on_wall = np.zeros(len(vertices), dtype=bool)
+  on_wall[walls[:, :2].ravel()] = True
+  corners = [(wedges[i, k], simplices[i, k]) for i in range(len(simplices)) for k in range(3)]
+  corners = sorted(set((w, v) for w, v in corners if on_wall[v] and wedge_angles[w] > np.pi - _EPSILON))
+  # Targets are the finish (index 0) and the reflex or flat corners.
+  target_wedges = np.array([-1] + [w for w, _ in corners], dtype=int)
+  target_ids = np.array([-1] + [v for _, v in corners], dtype=int)
+  targets = np.vstack([finish_point] + [vertices[v] for _, v in corners])
+  # Geodesic distance of the targets (Dijkstra over their visibility graph).
+  visible = _Visible(targets, target_ids, target_wedges, targets, target_ids, target_wedges, triangles, wedges, walls)
+  target_index = dict(((w, v), k) for k, (w, v) in enumerate(zip(target_wedges.tolist(), target_ids.tolist())))
+  for a, b, i in walls.tolist():
+    # Walking along a wall is always possible.
+    ka = target_index.get((wedges[i, simplices[i] == a][0], a))
+    kb = target_index.get((wedges[i, simplices[i] == b][0], b))
+    if ka is not None and kb is not None:
+      visible[ka, kb] = visible[kb, ka] = True
+  lengths = np.where(visible, np.hypot(*(targets[:, None, :] - targets[None, :, :]).transpose(2, 0, 1)), np.inf)
+  geodesics = np.full(len(targets), np.inf)
+  geodesics[0] = 0.
+  done = np.zeros(len(targets), dtype=bool)
+  while not done.all():
+    u = np.argmin(np.where(done, np.inf, geodesics))
+    if np.isinf(geodesics[u]):
+      break
+    done[u] = True
+    geodesics = np.minimum(geodesics, geodesics[u] + lengths[u])
+  # Distance of each point through its best visible target.
+  data = (points, targets, target_ids, target_wedges, geodesics, triangles, wedges, walls)
+  if pool is None or len(points) < _POOL_MIN_POINTS:
+    return np.concatenate([_ChunkDistances(data, begin, begin + _GEODESIC_CHUNK_SIZE)
+                           for begin in range(0, len(points), _GEODESIC_CHUNK_SIZE)])
+  # The pool may have been created long before, so the data is shipped through a file that each
+  # worker loads once. Tasks only hold the bounds of their chunk.
+  fd, filename = tempfile.mkstemp(suffix='.pkl')
+  try:
+    with os.fdopen(fd, 'wb') as fp:
+      pickle.dump(data, fp, pickle.HIGHEST_PROTOCOL)
+    return np.concatenate(pool.map(_PooledChunkDistances, [
+        (filename, begin, begin + _POOL_CHUNK_SIZE) for begin in range(0, len(points), _POOL_CHUNK_SIZE)]))
+  finally:
+    os.remove(filename)
+
+
+def _PooledChunkDistances(args):
+  # Pool workers call this function (see _GeodesicDistances()).
+  global _pooled_data
+  filename, begin, end = args
+  if _pooled_data is None or _pooled_data[0] != filename:
+    with open(filename, 'rb') as fp:
+      _pooled_data = (filename, pickle.load(fp))
+  return _ChunkDistances(_pooled_data[1], begin, end)
+
+
+def _ChunkDistances(data, begin, end):
+  # Distances of the points in [begin, end) (see _GeodesicDistances()).
+  points, targets, target_ids, target_wedges, geodesics, triangles, wedges, walls = data
+  points = points[begin:end]
+  ids = np.full(len(points), -1)
+  visible = _Visible(points, ids, ids, targets, target_ids, target_wedges, triangles, wedges, walls)
+  lengths = np.hypot(*(points[:, None, :] - targets[None, :, :]).transpose(2, 0, 1)) + geodesics
+  return np.where(visible, lengths, np.inf).min(axis=1)
+
+
+def _MergeWedges(wedges, w1, w2):
+  if w1 != w2:
+    wedges[wedges == w2] = w1
+
+
+def _Visible(sources, source_ids, source_wedges, targets, target_ids, target_wedges, triangles, wedges, walls):
+  # Returns whether the segment between each source and each target does not touch any wall,
+  # except at its own end points. Ids are vertex indices and segments ending at a vertex must
+  # leave it through the given wedge (-1 for other points).
+  sx, sy = sources[:, 0][:, None], sources[:, 1][:, None]
+  tx, ty = targets[:, 0][None, :], targets[:, 1][None, :]
+  dx, dy = tx - sx, ty - sy
+  blocked = np.zeros((len(sources), len(targets)), dtype=bool)
+  for a, b, _ in walls.tolist():
+    (ax, ay), (bx, by) = triangles.points[a], triangles.points[b]
+    o1 = dx * (ay - sy) - dy * (ax - sx)
+    o2 = dx * (by - sy) - dy * (bx - sx)
+    o3 = (bx - ax) * (sy - ay) - (by - ay) * (sx - ax)
+    o4 = (bx - ax) * (ty - ay) - (by - ay) * (tx - ax)
+    touching = (o1 * o2 <= 0.) & (o3 * o4 <= 0.)
+    # Collinear segments only touch if they overlap.
+    i, j = np.nonzero(touching)
+    collinear = (o1[i, j] == 0.) & (o2[i, j] == 0.)
+    if collinear.any():
+      i, j = i[collinear], j[collinear]
+      s, t = sources[i], targets[j]
+      touching[i, j] = ((np.minimum(s[:, 0], t[:, 0]) <= max(ax, bx)) & (np.maximum(s[:, 0], t[:, 0]) >= min(ax, bx)) &
+                        (np.minimum(s[:, 1], t[:, 1]) <= max(ay, by)) & (np.maximum(s[:, 1], t[:, 1]) >= min(ay, by)))
+    touching[(source_ids == a) | (source_ids == b)] = False
+    touching[:, (target_ids == a) | (target_ids == b)] = False
+    blocked |= touching
+  visible = ~blocked
+  visible &= _LeavesThrough(targets, target_ids, target_wedges, sources, triangles, wedges).T
+  visible &= _LeavesThrough(sources, source_ids, source_wedges, targets, triangles, wedges)
+  return visible
+
+
+def _LeavesThrough(origins, origin_ids, origin_wedges, destinations, triangles, wedges):
+  # Returns whether the segments from vertex origins to destinations start in the origin wedge.
+  leaves = np.ones((len(origins), len(destinations)), dtype=bool)
+  at_vertex = np.flatnonzero(origin_ids >= 0)
+  if not len(at_vertex):
+    return leaves
+  direction = destinations[None, :, :] - origins[at_vertex][:, None, :]
+  norm = np.hypot(direction[:, :, 0], direction[:, :, 1])[:, :, None]
+  with np.errstate(divide='ignore', invalid='ignore'):
+    probes = origins[at_vertex][:, None, :] + _WEDGE_PROBE * direction / norm
+  simplices = triangles.find_simplex(np.nan_to_num(probes).reshape(-1, 2)).reshape(len(at_vertex), len(destinations))
+  corner = triangles.simplices[simplices] == origin_ids[at_vertex][:, None, None]
+  wedge = wedges[simplices, corner.argmax(axis=2)]
+  leaves[at_vertex] = (simplices >= 0) & corner.any(axis=2) & (wedge == origin_wedges[at_vertex][:, None])
+  return leaves
 
 
 ####################################################
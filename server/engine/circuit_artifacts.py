@@ -0,0 +1,87 @@
+import atexit
+import copy
+import cPickle as pickle
+import numpy as np
+import os
+import shutil
+import tempfile
+import threading
+
+import circuit_analyzer
+
+
+# Circuit arrays stored as memory-mapped files. Workers share the pages of these files instead of
+# receiving a pickled copy. move_outcomes is filled lazily, so it is mapped read-write and fills
+# made by one process are visible to all the others (and so are its lookup counts).
+_CIRCUIT_ARRAYS = ('raster_points', 'raster_cells', 'moves_array', 'move_lookup', 'template_offsets', 'template_moves', 'move_outcomes',
+                   'move_outcome_counts')
+_WRITABLE_ARRAYS = ('move_outcomes', 'move_outcome_counts')
+_CIRCUIT_FILENAME = 'circuit.pkl'
+_ANALYZER_PREFIX = 'analyzer_'  # The arrays of CircuitAnalyzer.Compile() are stored with this prefix.
+
+_lock = threading.Lock()
+_circuits = {}  # Artifact name to circuit (published or attached in this process).
+_published_directories = []
+
+
+def Publish(circuit):
+  # Writes the artifacts of an analyzed circuit once and returns their name. The name can be
+  # passed to other processes, which get the circuit back with Attach().
+  with _lock:
+    name = getattr(circuit, 'artifacts_name', None)
+    if name is not None:
+      return name
+    assert circuit.analyzer is not None, 'Call SetAnalyzer() before calling Publish().'
+    name = tempfile.mkdtemp(prefix='cirkuit_%s_' % circuit.name.replace(os.sep, '_'))
+    _published_directories.append(name)
+    for array_name in _CIRCUIT_ARRAYS:
+      np.save(os.path.join(name, array_name + '.npy'), getattr(circuit, array_name))
+    for array_name, array in circuit.analyzer.Compile().items():
+      np.save(os.path.join(name, _ANALYZER_PREFIX + array_name + '.npy'), array)
+    # Everything else is small and pickled once.
+    light_circuit = copy.copy(circuit)
+    for array_name in _CIRCUIT_ARRAYS:
+      setattr(light_circuit, array_name, None)
+    light_circuit.move_templates = None
+    light_circuit.analyzer = None
+    light_circuit.onroad_cache = {}
+    light_circuit.artifacts_name = name
+    with open(os.path.join(name, _CIRCUIT_FILENAME), 'wb') as fp:
+      pickle.dump(light_circuit, fp, pickle.HIGHEST_PROTOCOL)
+    # From now on, this process also uses the shared move outcomes.
+    for array_name in _WRITABLE_ARRAYS:
+      setattr(circuit, array_name, _Load(name, array_name))
+    circuit.artifacts_name = name
+    _circuits[name] = circuit
+    return name
+
+
+def Attach(name):
+  # Returns the circuit (with its analyzer) published under the given name. Circuits are only
+  # loaded once per process.
+  with _lock:
+    if name in _circuits:
+      return _circuits[name]
+    with open(os.path.join(name, _CIRCUIT_FILENAME), 'rb') as fp:
+      circuit = pickle.load(fp)
+    for array_name in _CIRCUIT_ARRAYS:
+      setattr(circuit, array_name, _Load(name, array_name))
+    circuit._RestoreMoveTemplates()
+    compiled = {}
+    for filename in os.listdir(name):
+      if filename.startswith(_ANALYZER_PREFIX):
+        compiled[filename[len(_ANALYZER_PREFIX):-len('.npy')]] = np.load(os.path.join(name, filename), mmap_mode='r')
+    circuit.SetAnalyzer(circuit_analyzer.CircuitAnalyzer.FromCompiled(circuit, compiled))
+    _circuits[name] = circuit
+    return circuit
+
+
+def _Load(name, array_name):
+  mode = 'r+' if array_name in _WRITABLE_ARRAYS else 'r'
+  return np.load(os.path.join(name, array_name + '.npy'), mmap_mode=mode)
+
+
+@atexit.register
+def _Cleanup():
+  for name in _published_directories:
+    shutil.rmtree(name, ignore_errors=True)
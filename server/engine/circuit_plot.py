@@ -0,0 +1,59 @@
+# Plotting of the circuit analysis. This module is only imported when plotting is requested so
+# that the server does not load matplotlib.
+import matplotlib.pyplot as plt
+from matplotlib.patches import Polygon
+import numpy as np
+from scipy import interpolate
+
+
+def PlotPolygon(polygon):
+  plt.plot(polygon.exterior.xy[0], polygon.exterior.xy[1], 'k', linewidth=2)
+  plt.axis('equal')
+  plt.show()
+
+
+def PlotDistanceMap(circuit, distances, bounds, points, finish_point, triangles, triangle_tree):
+  # Plot distance.
+  if distances:
+    x = []
+    y = []
+    z = []
+    for k, v in distances.items():
+      x.append(k[0])
+      y.append(k[1])
+      z.append(v)
+    datapoints = np.array((x, y)).T
+    z = np.array(z)
+    XI, YI = np.meshgrid(range(bounds[0], bounds[2] + 1), range(bounds[1], bounds[3] + 1))
+    ZI = interpolate.griddata(datapoints, z, (XI, YI), method='nearest')
+    cmap = plt.get_cmap('RdYlGn_r')
+    im = plt.imshow(ZI, cmap=cmap, interpolation='nearest', origin='lower',
+                    extent=[bounds[0] - 0.5, bounds[2] + 0.5, bounds[1] - 0.5, bounds[3] + 0.5])
+    # Mask outside road.
+    plt.gca().add_patch(Polygon(circuit.raw_drivable_road.interiors[0].coords, facecolor='white', edgecolor='none'))
+    patch = Polygon(circuit.raw_drivable_road.exterior.coords, facecolor='none')
+    plt.gca().add_patch(patch)
+    im.set_clip_path(patch)
+
+  # Plot triangles.
+  plt.plot(np.append(points[:, 0], points[0, 0]), np.append(points[:, 1], points[0, 1]), 'k--', linewidth=2)
+  plt.plot(finish_point[0], finish_point[1], 'ro')
+  plt.triplot(points[:, 0], points[:, 1], triangles.simplices.copy())
+  for edge in triangle_tree.itervalues():
+    if edge is None:
+      continue
+    plt.plot([edge.start.xy[0], edge.end.xy[0]], [edge.start.xy[1], edge.end.xy[1]], 'c--')
+    plt.plot([edge.gate.left.xy[0]], [edge.gate.left.xy[1]], 'r+')
+    plt.plot([edge.gate.right.xy[0]], [edge.gate.right.xy[1]], 'b+')
+  # Plot grid.
+  valid_points = []
+  for x in range(bounds[0], bounds[2] + 1):
+    for y in range(bounds[1], bounds[3] + 1):
+      p = (x, y)
+      if p in distances:
+        valid_points.append(p)
+  if valid_points:
+    valid_points = np.array(valid_points).astype(float)
+    plt.scatter(valid_points[:, 0], valid_points[:, 1], c='gray', marker='+')
+  plt.axis('equal')
+  plt.show()
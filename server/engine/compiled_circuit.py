@@ -0,0 +1,69 @@
+from __future__ import print_function
+
+import hashlib
+import json
+import numpy as np
+import os
+import tempfile
+import zipfile
+
+import circuit
+
+# Directory holding the compiled circuits (disabled when None).
+_path = None
+
+# Compiled circuits are shared: give them the permissions of a regular file (mkstemp() only
+# gives access to the owner). The umask is read once since setting it is not thread-safe.
+_umask = os.umask(0)
+os.umask(_umask)
+_FILE_MODE = 0o644 & ~_umask
+
+
+def SetPath(path):
+  global _path
+  if path and not os.path.isdir(path):
+    os.makedirs(path)
+  _path = path
+
+
+def Load(name, version, kind=''):
+  # Returns the arrays stored by Save() for this circuit (a dict), or None if the circuit was
+  # never compiled, if its content changed or if the version differs. Different kinds of arrays
+  # can be stored for the same circuit.
+  filename = _Filename(name, version, kind)
+  if filename is None or not os.path.isfile(filename):
+    return None
+  try:
+    with np.load(filename) as data:
+      return dict((k, data[k]) for k in data.files)
+  except (IOError, OSError, ValueError, zipfile.BadZipfile) as e:
+    print('Ignoring compiled circuit %s: %s' % (filename, e))
+    return None
+
+
+def Save(name, version, arrays, kind=''):
+  filename = _Filename(name, version, kind)
+  if filename is None:
+    return
+  # Write to a temporary file first so that concurrent servers never read a partial file.
+  try:
+    fd, temporary_filename = tempfile.mkstemp(dir=_path, suffix='.tmp')
+    with os.fdopen(fd, 'wb') as fp:
+      np.savez(fp, **arrays)
+    os.chmod(temporary_filename, _FILE_MODE)
+    os.rename(temporary_filename, filename)
+  except (IOError, OSError) as e:
+    print('Unable to save compiled circuit %s: %s' % (filename, e))
+
+
+def _Filename(name, version, kind):
+  if _path is None:
+    return None
+  if name is None:
+    name = circuit._DEFAULT_CIRCUIT_NAME
+  try:
+    data = circuit.Circuit.GetData(name)
+  except circuit.CircuitDoesNotExistError:
+    return None
+  key = hashlib.sha1(json.dumps([data, version], sort_keys=True)).hexdigest()
+  return os.path.join(_path, '%s-%s%s.npz' % (name.replace(os.sep, '_'), key, '.' + kind if kind else ''))
@@ -1,5 +1,9 @@
+import numpy as np
+
+from circuit import DOOMED_MARK
 from circuit import STATUS_CRASHED
 from circuit import STATUS_FINISHED
+from circuit import STATUS_RUNNING
 from player import ComputerPlayer
 
 
@@ -20,27 +24,37 @@ class FixedDepthPlayer(ComputerPlayer):
     return move_index
 
 
-def _GetDistanceScore(circuit, state):
-    return float(circuit.Laps() - state.lap - 1) * circuit.LapLength() + state.distance_left
+def _GetDistanceScore(circuit, states):
+    return (circuit.Laps() - states['lap'] - 1).astype(float) * circuit.LapLength() + states['distance_left']
+
+
+def _GetLeafScore(circuit, states):
+  score = _GetDistanceScore(circuit, states)
+  score[states['status'] == STATUS_CRASHED] += _CRASH_SCORE
+  finished = states['status'] == STATUS_FINISHED
+  score[finished] = states['round'][finished] + _MINIMUM_SCORE
+  return score
 
 
 def _GetBestMove(states, circuit, depth):
-  best_index = None
-  best_score = None
-  for i, state in enumerate(states):
-    if state.status == STATUS_CRASHED:
-      score = _GetDistanceScore(circuit, state) + _CRASH_SCORE
-    elif state.status == STATUS_FINISHED:
-      score = float(state.round) + _MINIMUM_SCORE
-    elif depth == 0:
-      score = _GetDistanceScore(circuit, state)
-    else:
-      # We don't care about the other players beyond the first depth.
-      next_states = circuit.GetNextStates(state)
-      _, score = _GetBestMove(next_states, circuit, depth - 1)
-      if score is None:
-        continue
-    if best_index is None or score < best_score:  # Smaller is better.
-      best_index = i
-      best_score = score
-  return best_index, best_score
+  # The tree is expanded one layer at a time.
+  layers = [circuit.ToBatch(states)]
+  layer_offsets = []
+  for _ in range(depth):
+    # Doomed states are scored as crashes without being expanded.
+    next_states, offsets = circuit.GetNextStatesBatch(layers[-1], doomed=DOOMED_MARK)
+    layers.append(next_states)
+    layer_offsets.append(offsets)
+  # Scores are propagated from the deepest layer up (smaller is better). States without any
+  # successor get a NaN score and are ignored.
+  scores = _GetLeafScore(circuit, layers[-1])
+  for layer, offsets in reversed(zip(layers[:-1], layer_offsets)):
+    best_successor = np.full(len(layer), np.nan)
+    has_successors = offsets[1:] > offsets[:-1]
+    if np.any(has_successors):
+      best_successor[has_successors] = np.fmin.reduceat(scores, offsets[:-1][has_successors])
+    scores = np.where(layer['status'] == STATUS_RUNNING, best_successor, _GetLeafScore(circuit, layer))
+  if not len(scores) or np.all(np.isnan(scores)):
+    return None, None
+  best_index = int(np.nanargmin(scores))
+  return best_index, float(scores[best_index])
@@ -0,0 +1,121 @@
+from __future__ import print_function
+
+import math
+import random
+import time
+
+from circuit import DOOMED_REMOVE
+from circuit import STATUS_FINISHED
+from circuit import STATUS_RUNNING
+from player import ComputerPlayer
+
+# xrange compatibility.
+try:
+    xrange
+except NameError:
+    xrange = range
+
+
+_TIME_BUDGET = 1.  # Seconds spent per move.
+_EXPLORATION = 1.  # In rounds (costs are measured in rounds).
+_ROLLOUT_DEPTH = 3
+
+
+class _Node(object):
+  """Node of the search tree. The cost of a node is the number of rounds at the end of the race."""
+  __slots__ = ('state', 'children', 'visits', 'total_cost')
+
+  def __init__(self, state):
+    self.state = state  # CompactState.
+    self.children = None  # Not expanded yet.
+    self.visits = 0
+    self.total_cost = 0.
+
+
+class MCTSPlayer(ComputerPlayer):
+  """Monte Carlo tree search (UCT) that keeps the subtree of the chosen move between turns."""
+
+  def __init__(self, time_budget=_TIME_BUDGET):
+    ComputerPlayer.__init__(self)
+    self.time_budget = time_budget
+    self.root = None  # Node of the last chosen move.
+
+  def Play(self, circuit, players):
+    deadline = time.time() + self.time_budget
+    root = self._Reroot(circuit)
+    # Moves that cannot avoid crashing are never searched.
+    candidates = [k for k, viable in enumerate(circuit.ViableBatch(circuit.ToBatch([c.state for c in root.children])))
+                  if viable]
+    if not candidates:
+      self.root = None
+      return 0
+    iterations = 0
+    while iterations == 0 or time.time() < deadline:
+      _Iterate(circuit, root, candidates)
+      iterations += 1
+    # The most visited move is the most robust.
+    move_index = max(candidates, key=lambda k: root.children[k].visits)
+    self.root = root.children[move_index]
+    print('Best move with expected rounds = %.2f' % (self.root.total_cost / self.root.visits),
+          'found with %d iterations (%d reused).' % (iterations, root.visits - iterations))
+    return move_index
+
+  def _Reroot(self, circuit):
+    # The root holds the allowed moves in order. Subtrees of the previous search are kept if the
+    # played move is the one chosen last turn (it always is unless the race restarted).
+    state = self.GetState()
+    previous_children = {}
+    if self.root is not None and state is not None and self.root.state == circuit.ToCompact(state) and self.root.children:
+      previous_children = dict((c.state.key, c) for c in self.root.children)
+    root = _Node(circuit.ToCompact(state) if state is not None else None)
+    root.children = []
+    for s in self.allowed_moves:
+      s = circuit.ToCompact(s)
+      child = previous_children.get(s.key)
+      root.children.append(child if child is not None else _Node(s))
+      root.visits += root.children[-1].visits
+    return root
+
+
+def _Iterate(circuit, root, candidates):
+  # Selection.
+  path = [root]
+  node = root
+  while node.children:
+    node = _Select(node, candidates if node is root else None)
+    path.append(node)
+  # Expansion.
+  if node.state.status == STATUS_RUNNING and node.visits:
+    node.children = [_Node(s) for s in circuit.GetNextStates(node.state, compact=True, doomed=DOOMED_REMOVE)]
+    if node.children:
+      node = random.choice(node.children)
+      path.append(node)
+  # Simulation and backpropagation.
+  cost = _Rollout(circuit, node.state)
+  for node in path:
+    node.visits += 1
+    node.total_cost += cost
+
+
+def _Select(node, candidates=None):
+  children = node.children if candidates is None else [node.children[k] for k in candidates]
+  unvisited = [c for c in children if not c.visits]
+  if unvisited:
+    return random.choice(unvisited)
+  log_visits = math.log(node.visits)
+  # Lowest cost first.
+  return min(children, key=lambda c: c.total_cost / c.visits - _EXPLORATION * math.sqrt(log_visits / c.visits))
+
+
+def _Rollout(circuit, state):
+  # Random non-crashing moves followed by the rounds-to-go bound (see Circuit.RoundsToGo()).
+  for _ in xrange(_ROLLOUT_DEPTH):
+    if state.status != STATUS_RUNNING:
+      break
+    next_states = circuit.GetNextStates(state, compact=True, doomed=DOOMED_REMOVE)
+    if not next_states:
+      break
+    state = random.choice(next_states)
+  if state.status == STATUS_FINISHED:
+    return float(state.round)
+  return float(state.round) + circuit.RoundsToGo(state)
@@ -1,7 +1,6 @@
 from __future__ import print_function
 
-import multiprocessing
-import random
+import numpy as np
 import time
 
 # For test (ugly as hell).
@@ -16,18 +15,13 @@ if __name__ == '__main__':
 from circuit import STATUS_CRASHED
 from circuit import STATUS_FINISHED
 from player import ComputerPlayer
-
-# xrange compatibility.
-try:
-    xrange
-except NameError:
-    xrange = range
-
+import batch_rollout
+import circuit_artifacts
+import rollout_pool
 
 # A depth of 2 will expand the moves 3 times (0 -> direct moves, 1 -> lookahead of 1 move, ...)
 _MAX_DEPTH = 6
-_NUM_RANDOM_PLAY_PER_THREAD = 400
-_NUM_THREADS = 8
+_NUM_RANDOM_PLAYS = 100000  # Split evenly across the rollout processes.
 _MINIMUM_SCORE = -1e6
 _CRASH_SCORE = 1e6
 
@@ -38,54 +32,44 @@ class MonteCarloPlayer(ComputerPlayer):
     ComputerPlayer.__init__(self)
 
   def Play(self, circuit, players):
-    # Run multiple threads and pick the best.
-    start_time = time.clock()
-    if _NUM_THREADS > 1:
-      pool = multiprocessing.Pool(processes=_NUM_THREADS)
-      results = pool.map(_GetBestMove, [(self.allowed_moves, circuit)] * _NUM_THREADS)
-      score, move_index = min(results)
-      pool.terminate()
-    else:
-      score, move_index = _GetBestMove((self.allowed_moves, circuit))
-    end_time = time.clock()
+    # Run the random plays in the shared rollout processes and pick the best.
+    start_time = time.time()
+    # Workers attach to the circuit artifacts instead of receiving a pickled circuit. Only the
+    # root states and the number of random plays are sent for each move.
+    circuit_name = circuit_artifacts.Publish(circuit)
+    states = [circuit.ToCompact(s) for s in self.allowed_moves]
+    num_tasks = rollout_pool.NumProcesses()
+    num_random_plays = (_NUM_RANDOM_PLAYS + num_tasks - 1) // num_tasks
+    results = rollout_pool.Map(_GetBestMove, [(states, circuit_name, num_random_plays)] * num_tasks)
+    score, move_index = min(results)
+    end_time = time.time()
     print('Best final state with score =', score, 'found in %.2f ms' % ((end_time - start_time) * 1000.))
     print('Best score found with depth %d:' % _MAX_DEPTH, score)
     return move_index
 
 
-def _Done(state):
-  return state.status == STATUS_FINISHED or state.status == STATUS_CRASHED
+def _GetDistanceScores(circuit, states):
+  return (circuit.Laps() - states['lap'] - 1).astype(float) * circuit.LapLength() + states['distance_left']
 
 
-def _GetDistanceScore(circuit, state):
-    return float(circuit.Laps() - state.lap - 1) * circuit.LapLength() + state.distance_left
+def _GetScores(circuit, states):
+  scores = _GetDistanceScores(circuit, states)
+  crashed = states['status'] == STATUS_CRASHED
+  scores[crashed] += _CRASH_SCORE
+  finished = states['status'] == STATUS_FINISHED
+  scores[finished] = states['round'][finished] + _MINIMUM_SCORE
+  return scores
 
 
 def _GetBestMove(argument):
-  states, circuit = argument
-  best_index = None
-  best_score = None
-  for _ in xrange(_NUM_RANDOM_PLAY_PER_THREAD):
-    # Pick first move at random and remember index.
-    index = random.choice(xrange(len(states)))
-    current_state = states[index]
-    if not _Done(current_state):
-      for _ in xrange(_MAX_DEPTH):
-        # We don't care about the other players beyond the first depth.
-        next_states = circuit.GetNextStates(current_state)
-        current_state = next_states[random.choice(xrange(len(next_states)))]
-        if _Done(current_state):
-          break
-    if current_state.status == STATUS_CRASHED:
-      score = _GetDistanceScore(circuit, current_state) + _CRASH_SCORE
-    elif current_state.status == STATUS_FINISHED:
-      score = float(current_state.round) + _MINIMUM_SCORE
-    else:
-      score = _GetDistanceScore(circuit, current_state)
-    if best_index is None or score < best_score:  # Smaller is better.
-      best_index = index
-      best_score = score
-  return best_score, best_index
+  states, circuit_name, num_random_plays = argument
+  circuit = circuit_artifacts.Attach(circuit_name)
+  # We don't care about the other players beyond the first depth. Rollouts stop as soon as a
+  # crash is unavoidable.
+  statistics = batch_rollout.Rollouts(circuit, states, num_random_plays, _MAX_DEPTH,
+                                      lambda final_states: _GetScores(circuit, final_states))
+  best_index = int(np.argmin(statistics['best']))
+  return float(statistics['best'][best_index]), best_index
 
 
 if __name__ == '__main__':
@@ -95,6 +79,7 @@ if __name__ == '__main__':
   args = parser.parse_args()
   if args.circuit_directory:
     Circuit.SetPath(args.circuit_directory)
+  rollout_pool.Start()
   circuit = circuit_analyzer.GetAnalyzableCircuit(args.circuit_name)
   p = MonteCarloPlayer()
   p.SetAllowedMoves(circuit, [])
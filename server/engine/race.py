@@ -71,8 +71,9 @@ class RaceThread(threading.Thread):
 
 class Race(object):
 
-  def __init__(self, circuit_name=None):
-    self.circuit = circuit_analyzer.GetAnalyzableCircuit(circuit_name)
+  def __init__(self, circuit_name=None, block=True):
+    # If block is False, AnalyzerBuildingError is raised while the circuit is being analyzed.
+    self.circuit = circuit_analyzer.GetAnalyzableCircuit(circuit_name, block=block)
     self.must_stop_lock = util.RWLock()
     self.must_stop = False
     self.snapshot_lock = util.RWLock()
@@ -0,0 +1,62 @@
+import atexit
+import multiprocessing
+import numpy as np
+import random
+import threading
+
+# Rollouts of all games run in a single pool of worker processes that lives as long as the server.
+# Workers keep their state between tasks, so circuits are only attached once per worker (see
+# circuit_artifacts.Attach()).
+_num_processes = None  # One per CPU.
+_pool = None
+_pool_lock = threading.Lock()
+
+
+class Error(Exception):
+  pass
+
+
+class PoolAlreadyStartedError(Error):
+  pass
+
+
+def Start(processes=None):
+  # Starts the pool with the given number of processes (None or 0 for one process per CPU). Must
+  # be called before the first rollout.
+  global _num_processes, _pool
+  with _pool_lock:
+    if _pool is not None:
+      raise PoolAlreadyStartedError('The rollout pool is already running.')
+    _num_processes = processes or None
+    # The pool is created right away, before other threads are started (a forked worker would
+    # otherwise inherit the locks held by other threads).
+    _pool = multiprocessing.Pool(processes=NumProcesses(), initializer=_InitializeWorker)
+
+
+def NumProcesses():
+  return _num_processes or multiprocessing.cpu_count()
+
+
+def Map(function, arguments):
+  # Runs function (which must be picklable, i.e., defined at the module level) on each argument
+  # and returns the results in order. Can be called concurrently by multiple games.
+  return _GetPool().map(function, arguments)
+
+
+def _GetPool():
+  with _pool_lock:
+    assert _pool is not None, 'Call Start() before Map().'
+    return _pool
+
+
+def _InitializeWorker():
+  # Forked workers would otherwise all draw the same random numbers.
+  random.seed()
+  np.random.seed()
+
+
+@atexit.register
+def _Shutdown():
+  with _pool_lock:
+    if _pool is not None:
+      _pool.terminate()
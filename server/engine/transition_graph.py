@@ -0,0 +1,126 @@
+import numpy as np
+
+import circuit as circuit_module
+
+# A node is a discretized state: position, last move (which determines the yaw and speed), lap and
+# status. The round is not part of it.
+NODE_DTYPE = np.dtype([
+    ('x', np.int32), ('y', np.int32), ('dx', np.int8), ('dy', np.int8), ('lap', np.int16), ('status', np.int8)])
+
+# Attributes of the edge leading to a successor. dround is the number of rounds (possibly
+# fractional when finishing) spent on the move and distance is the distance left after the move.
+EDGE_DTYPE = np.dtype([('status', np.int8), ('dlap', np.int8), ('dround', float), ('distance', float)])
+
+
+class TransitionGraph(object):
+  """All reachable states of a circuit and their successors in compressed sparse row format.
+
+  The successors of node i are targets[offsets[i]:offsets[i + 1]] and the corresponding edges are
+  edges[offsets[i]:offsets[i + 1]]. Crashed and finished nodes have no successors, and neither do
+  running nodes below the minimum lap (driving backwards decreases the lap without bound).
+  Positions occupied by other players are not taken into account.
+  """
+
+  def __init__(self, nodes, offsets, targets, edges, starts, min_lap):
+    self.nodes = nodes
+    self.offsets = offsets
+    self.targets = targets
+    self.edges = edges
+    self.starts = starts  # Nodes at the start of the race.
+    self.min_lap = min_lap
+    keys = _NodeKeys(nodes)
+    self.sorted_keys_order = np.argsort(keys)
+    self.sorted_keys = keys[self.sorted_keys_order]
+
+  def NumNodes(self):
+    return len(self.nodes)
+
+  def NumEdges(self):
+    return len(self.targets)
+
+  def Index(self, key):
+    # Returns the node of a packed state (see CompactState.key), or -1 if it is not reachable.
+    return int(self.Indices(np.array([key], dtype=np.int64))[0])
+
+  def Indices(self, keys):
+    # Vectorized version of Index().
+    k = np.minimum(np.searchsorted(self.sorted_keys, keys), len(self.sorted_keys) - 1)
+    return np.where(self.sorted_keys[k] == keys, self.sorted_keys_order[k], -1)
+
+  def Successors(self, node):
+    # Returns the successor nodes and the edges leading to them.
+    begin, end = self.offsets[node], self.offsets[node + 1]
+    return self.targets[begin:end], self.edges[begin:end]
+
+  def Arrays(self):
+    return {
+        'nodes': self.nodes,
+        'offsets': self.offsets,
+        'targets': self.targets,
+        'edges': self.edges,
+        'starts': self.starts,
+        'min_lap': np.array(self.min_lap),
+    }
+
+  @staticmethod
+  def FromArrays(arrays):
+    return TransitionGraph(arrays['nodes'], arrays['offsets'], arrays['targets'], arrays['edges'], arrays['starts'], int(arrays['min_lap']))
+
+
+def Build(circuit, min_lap=-1):
+  # Enumerates all states reachable from the starting points, one layer at a time.
+  assert circuit.analyzer is not None, 'Call SetAnalyzer() before calling Build().'
+  frontier = circuit.ToBatch(circuit.GetNextStates())
+  node_indices = {}
+  nodes = []
+  for key in _NodeKeys(frontier).tolist():
+    node_indices[key] = len(node_indices)
+  nodes.append(frontier)
+  starts = np.arange(len(frontier))
+  frontier_indices = starts
+  counts = []
+  targets = []
+  edges = []
+  while len(frontier):
+    next_states, offsets = circuit.GetNextStatesBatch(frontier)
+    parents = np.repeat(np.arange(len(frontier)), np.diff(offsets))
+    layer_counts = np.zeros(len(node_indices), dtype=int)
+    layer_counts[frontier_indices] = np.diff(offsets)
+    counts.append(layer_counts)
+    layer_edges = np.zeros(len(next_states), dtype=EDGE_DTYPE)
+    layer_edges['status'] = next_states['status']
+    layer_edges['dlap'] = next_states['lap'] - frontier['lap'][parents]
+    layer_edges['dround'] = next_states['round'] - frontier['round'][parents]
+    layer_edges['distance'] = next_states['distance_left']
+    edges.append(layer_edges)
+    # Number the new nodes.
+    first_index = len(node_indices)
+    layer_targets = np.array([node_indices.setdefault(key, len(node_indices)) for key in _NodeKeys(next_states).tolist()], dtype=np.int64)
+    targets.append(layer_targets)
+    new = layer_targets >= first_index
+    _, first_occurrences = np.unique(layer_targets[new], return_index=True)
+    new_states = next_states[new][first_occurrences]
+    nodes.append(new_states)
+    # The round only matters at the start of the race (round 1). Starting from 0 keeps dround exact.
+    expand = (new_states['status'] == circuit_module.STATUS_RUNNING) & (new_states['lap'] >= min_lap)
+    frontier_indices = np.arange(first_index, len(node_indices))[expand]
+    frontier = new_states[expand]
+    frontier['round'] = 0.
+  # Nodes numbered in the last layers have no successors.
+  num_nodes = len(node_indices)
+  node_counts = np.zeros(num_nodes, dtype=int)
+  for layer_counts in counts:
+    node_counts[:len(layer_counts)] += layer_counts
+  batch = np.concatenate(nodes)
+  graph_nodes = np.zeros(num_nodes, dtype=NODE_DTYPE)
+  for field in NODE_DTYPE.names:
+    graph_nodes[field] = batch[field]
+  return TransitionGraph(graph_nodes, np.concatenate(([0], np.cumsum(node_counts))),
+                         np.concatenate(targets), np.concatenate(edges), starts, min_lap)
+
+
+def _NodeKeys(states):
+  return circuit_module.PackState(
+      states['x'].astype(np.int64), states['y'].astype(np.int64), states['dx'].astype(np.int64),
+      states['dy'].astype(np.int64), states['lap'].astype(np.int64), states['status'].astype(np.int64))
+
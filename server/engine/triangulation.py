@@ -0,0 +1,170 @@
+import numpy as np
+
+_EPSILON = 1e-12  # Tolerance of find_simplex() in barycentric coordinates.
+_INCIRCLE_EPSILON = 1e-9  # Avoids flipping edges back and forth between cocircular points.
+
+
+class Error(Exception):
+  pass
+
+
+class TriangulationError(Error):
+  pass
+
+
+class Triangulation(object):
+  """Triangulation with the attributes of scipy.spatial.Delaunay used by the circuit analyzer.
+
+  neighbors[i, k] is the triangle opposite to vertex simplices[i, k] (-1 on the boundary) and
+  transform holds the affine transforms to barycentric coordinates.
+  """
+
+  def __init__(self, points, simplices):
+    self.points = points
+    self.simplices = simplices
+    self.neighbors = _Neighbors(simplices)
+    self.transform = _Transform(points, simplices)
+    self._BuildCells()
+
+  def find_simplex(self, xi):
+    # Returns the index of a triangle containing each point (-1 if none).
+    xi = np.asarray(xi, dtype=float)
+    cells = np.floor(xi - self.cells_origin).astype(int)
+    inside = (cells >= 0).all(axis=1) & (cells < self.cells_shape).all(axis=1)
+    candidates = np.full((len(xi), self.cell_triangles.shape[2]), -1, dtype=int)
+    candidates[inside] = self.cell_triangles[cells[inside, 0], cells[inside, 1]]
+    # Barycentric coordinates in the candidate triangles.
+    t = np.maximum(candidates, 0)
+    x = xi[:, 0, None] - self.transform[t, 2, 0]
+    y = xi[:, 1, None] - self.transform[t, 2, 1]
+    b0 = self.transform[t, 0, 0] * x + self.transform[t, 0, 1] * y
+    b1 = self.transform[t, 1, 0] * x + self.transform[t, 1, 1] * y
+    contained = (candidates >= 0) & (b0 >= -_EPSILON) & (b1 >= -_EPSILON) & (b0 + b1 <= 1. + _EPSILON)
+    return np.where(contained.any(axis=1), candidates[np.arange(len(xi)), contained.argmax(axis=1)], -1)
+
+  def _BuildCells(self):
+    # Unit cells listing the triangles whose bounding box overlaps them.
+    self.cells_origin = np.floor(self.points.min(axis=0)) - 1.
+    self.cells_shape = (np.floor(self.points.max(axis=0) - self.cells_origin) + 2).astype(int)
+    cells = {}
+    corners = self.points[self.simplices]
+    low = np.floor(corners.min(axis=1) - self.cells_origin).astype(int)
+    high = np.floor(corners.max(axis=1) - self.cells_origin).astype(int)
+    for i in range(len(self.simplices)):
+      for x in range(low[i, 0], high[i, 0] + 1):
+        for y in range(low[i, 1], high[i, 1] + 1):
+          cells.setdefault((x, y), []).append(i)
+    self.cell_triangles = np.full(tuple(self.cells_shape) + (max(len(v) for v in cells.values()),), -1, dtype=int)
+    for (x, y), triangles in cells.items():
+      self.cell_triangles[x, y, :len(triangles)] = triangles
+
+
+def TriangulatePolygon(points):
+  # Returns the constrained Delaunay triangulation of a simple polygon given by its vertices (the
+  # closing vertex and repeated vertices are dropped). All triangles are inside the polygon and
+  # all vertices are kept. The polygon is first triangulated by ear clipping and its diagonals
+  # are then flipped until the triangulation is Delaunay.
+  points = np.asarray(points, dtype=float)
+  keep = np.any(points != np.roll(points, 1, axis=0), axis=1)
+  points = points[keep]
+  if len(points) < 3:
+    raise TriangulationError('The polygon has less than 3 vertices.')
+  order = np.arange(len(points))
+  x, y = points[:, 0], points[:, 1]
+  if np.dot(x, np.roll(y, -1)) - np.dot(np.roll(x, -1), y) < 0.:
+    order = order[::-1]  # Counter-clockwise.
+  simplices = _ClipEars(points, order.tolist())
+  _FlipEdges(points, simplices)
+  return Triangulation(points, np.array(simplices, dtype=np.int32).reshape(-1, 3))
+
+
+def _Cross(o, a, b):
+  return (a[..., 0] - o[..., 0]) * (b[..., 1] - o[..., 1]) - (a[..., 1] - o[..., 1]) * (b[..., 0] - o[..., 0])
+
+
+def _ClipEars(points, remaining):
+  def IsEar(k):
+    a, b, c = remaining[k - 1], remaining[k], remaining[(k + 1) % len(remaining)]
+    if _Cross(points[a], points[b], points[c]) <= 0.:
+      return False
+    # No other vertex may be inside the ear or on its boundary.
+    others = points[[v for v in remaining if v not in (a, b, c)]]
+    inside = ((_Cross(points[a], points[b], others) >= 0.) & (_Cross(points[b], points[c], others) >= 0.) &
+              (_Cross(points[c], points[a], others) >= 0.))
+    return not inside.any()
+
+  simplices = []
+  ears = [IsEar(k) for k in range(len(remaining))]
+  while len(remaining) > 3:
+    if not any(ears):
+      raise TriangulationError('Unable to find an ear (is the polygon simple?).')
+    k = ears.index(True)
+    simplices.append((remaining[k - 1], remaining[k], remaining[(k + 1) % len(remaining)]))
+    del remaining[k]
+    del ears[k]
+    # Only the neighbors of the clipped vertex change.
+    for j in (k - 1, k % len(remaining)):
+      ears[j] = IsEar(j)
+  simplices.append(tuple(remaining))
+  return simplices
+
+
+def _InCircle(a, b, c, d):
+  # Positive if d is inside the circumcircle of the counter-clockwise triangle abc.
+  (ax, ay), (bx, by), (cx, cy) = [(p[0] - d[0], p[1] - d[1]) for p in (a, b, c)]
+  return ((ax * ax + ay * ay) * (bx * cy - by * cx) - (bx * bx + by * by) * (ax * cy - ay * cx) +
+          (cx * cx + cy * cy) * (ax * by - ay * bx))
+
+
+def _FlipEdges(points, simplices):
+  # Lawson flips. The edges of the polygon are never shared by two triangles and are kept.
+  points = points.tolist()
+  flipped = True
+  while flipped:
+    flipped = False
+    edges = {}
+    for i, simplex in enumerate(simplices):
+      for k in range(3):
+        edges.setdefault(frozenset((simplex[(k + 1) % 3], simplex[(k + 2) % 3])), []).append((i, simplex[k]))
+    changed = set()
+    for edge, triangles in edges.items():
+      if len(triangles) != 2:
+        continue
+      (i, p), (j, q) = triangles
+      if i in changed or j in changed:
+        continue
+      # Vertices of triangle i in counter-clockwise order, starting after p.
+      k = simplices[i].index(p)
+      u, v = simplices[i][(k + 1) % 3], simplices[i][(k + 2) % 3]
+      if _InCircle(points[u], points[v], points[p], points[q]) <= _INCIRCLE_EPSILON:
+        continue
+      simplices[i] = (p, u, q)
+      simplices[j] = (q, v, p)
+      changed.update((i, j))
+      flipped = True
+
+
+def _Neighbors(simplices):
+  neighbors = np.full(simplices.shape, -1, dtype=np.int32)
+  edges = {}
+  for i, simplex in enumerate(simplices.tolist()):
+    for k in range(3):
+      edge = frozenset((simplex[(k + 1) % 3], simplex[(k + 2) % 3]))
+      if edge in edges:
+        j, l = edges.pop(edge)
+        neighbors[i, k] = j
+        neighbors[j, l] = i
+      else:
+        edges[edge] = (i, k)
+  return neighbors
+
+
+def _Transform(points, simplices):
+  # Same layout as scipy.spatial.Delaunay.transform: barycentric coordinates of x in triangle i
+  # are transform[i, :2].dot(x - transform[i, 2]) (the third one sums to one).
+  corners = points[simplices]
+  t = np.stack((corners[:, 0] - corners[:, 2], corners[:, 1] - corners[:, 2]), axis=2)
+  transform = np.empty((len(simplices), 3, 2))
+  transform[:, :2] = np.linalg.inv(t)
+  transform[:, 2] = corners[:, 2]
+  return transform
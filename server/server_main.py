@@ -1,12 +1,36 @@
 import argparse
+import os
+import sys
+import time
+
+# Measure the startup cost of the server modules (see _ImportReport()).
+_import_start_time = time.time()
 import core
 import engine
+_import_time = time.time() - _import_start_time
+
+# Modules only needed to plot or analyze circuits offline.
+_OFFLINE_MODULES = ('matplotlib', 'scipy.interpolate')
+
+
+def _ImportReport():
+  offline_modules = [m for m in _OFFLINE_MODULES if sys.modules.get(m) is not None]
+  print 'Imported server modules in %.0f ms (%d modules loaded).' % (_import_time * 1000., len(sys.modules))
+  if offline_modules:
+    print 'Warning: offline modules loaded at startup: %s' % ', '.join(offline_modules)
 
 
 def Run(args):
+  _ImportReport()
   server = core.Server(args.root, host=args.host, port=args.port)
   if args.circuit_directory:
     engine.Circuit.SetPath(args.circuit_directory)
+  if args.compiled_circuit_directory:
+    engine.SetCompiledCircuitPath(args.compiled_circuit_directory)
+  # Both pools are forked before any thread is started.
+  engine.StartRolloutPool(processes=args.rollout_processes or None)
+  if args.warmup_processes >= 0:
+    engine.WarmupCircuits(processes=args.warmup_processes or None)
   server.Start()
 
 
@@ -14,6 +38,12 @@ if __name__ == '__main__':
   parser = argparse.ArgumentParser()
   parser.add_argument("--root", metavar='DIRECTORY', type=str, required=True, help="The root directory where the client files are located.")
   parser.add_argument("--circuit_directory", metavar='DIRECTORY', type=str, required=False, help="The directory where the circuit files are located.")
+  parser.add_argument("--compiled_circuit_directory", metavar='DIRECTORY', type=str, default=os.path.join(os.path.expanduser('~'), '.cache', 'cirkuit'),
+                      help="The directory where analyzed circuits are stored to speed up restarts (empty to disable).")
+  parser.add_argument("--warmup_processes", metavar='N', type=int, default=0,
+                      help="Number of processes analyzing circuits at startup (0 for one per CPU, -1 to analyze circuits on demand).")
+  parser.add_argument("--rollout_processes", metavar='N', type=int, default=0,
+                      help="Number of processes running the rollouts of computer players, shared by all games (0 for one per CPU).")
   parser.add_argument("--host", metavar='IP', type=str, default='localhost', help="The server hostname.")
   parser.add_argument("--port", metavar='PORT', type=int, default=8080, help="The server port.")
   Run(parser.parse_args())